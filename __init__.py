@@ -2,6 +2,8 @@
 # copyright notices and license terms.
 from trytond.pool import Pool
 from . import contract
+from . import instrumentation
+from . import ir
 from . import payslip
 
 
@@ -12,12 +14,21 @@ def register():
         contract.ContractRule,
         contract.Contract,
         contract.ContractHoursSummary,
+        contract.ContractHoursSummaryCache,
         contract.Employee,
         payslip.Payslip,
         payslip.PayslipLine,
+        payslip.LeavePeriod,
+        payslip.Leave,
         payslip.Entitlement,
         payslip.LeavePayment,
         payslip.WorkingShift,
         payslip.Intervention,
         payslip.InvoiceLine,
+        payslip.GeneratePayslipsStart,
+        instrumentation.InstrumentationStat,
+        ir.Cron,
         module='payroll', type_='model')
+    Pool.register(
+        payslip.GeneratePayslips,
+        module='payroll', type_='wizard')
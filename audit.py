@@ -0,0 +1,135 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Check that the cost cache of the done working shifts matches the cost
+computed with the current contracts and rules:
+
+    python -m trytond.modules.payroll.audit -c trytond.conf -d DATABASE
+
+The working shifts are checked in id range chunks spread across a pool of
+processes, each one with its own transaction. The working shifts that differ
+are printed with their cached and computed costs and, with --repair, the
+cache values of those not invoiced are updated. The costs of the invoiced
+working shifts are only reported as they can not be repaired, and the
+working shifts without cost cache are reported separately.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+
+from sql.aggregate import Max, Min
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+def init(config_file, database):
+    "Load the configuration and the pool of the database"
+    config.update_etc(config_file)
+    Pool.start()
+    Pool(database).init()
+
+
+def get_chunks(database, chunk_size):
+    "Return the (first id, last id) ranges of the done working shifts"
+    with Transaction().start(database, 0, readonly=True) as transaction:
+        pool = Pool()
+        WorkingShift = pool.get('working_shift')
+        table = WorkingShift.__table__()
+        cursor = transaction.connection.cursor()
+        cursor.execute(*table.select(Min(table.id), Max(table.id),
+                where=table.state == 'done'))
+        first_id, last_id = cursor.fetchone()
+    if first_id is None:
+        return []
+    return [(i, min(i + chunk_size - 1, last_id))
+        for i in range(first_id, last_id + 1, chunk_size)]
+
+
+def audit_chunk(database, first_id, last_id, repair=False):
+    """
+    Compare the cost cache of the done working shifts from first_id to
+    last_id with their computed cost.
+    Return the number of checked working shifts, the list of (working shift
+    id, cached cost, computed cost, invoiced) that differ and the list of
+    working shift ids in a payslip with a cost but without cost cache.
+    With repair, the working shifts that differ and are not invoiced are
+    updated.
+    """
+    with Transaction().start(database, 0, readonly=not repair):
+        pool = Pool()
+        WorkingShift = pool.get('working_shift')
+        working_shifts = WorkingShift.search([
+                ('id', '>=', first_id),
+                ('id', '<=', last_id),
+                ('state', '=', 'done'),
+                ], order=[('id', 'ASC')])
+        costs = WorkingShift._calc_costs(working_shifts)
+        drift, missing = [], []
+        for ws in working_shifts:
+            if ws.cost_cache is None:
+                # Without payslip or rule there is no cache by design
+                if ws.payslip_line and costs[ws.id]:
+                    missing.append(ws.id)
+            elif ws.cost_cache != costs[ws.id]:
+                invoiced = bool(ws.payslip and ws.payslip.supplier_invoice)
+                drift.append((ws.id, ws.cost_cache, costs[ws.id], invoiced))
+        # The costs of the invoiced working shifts must not change
+        to_repair = [d[0] for d in drift if not d[3]]
+        if repair and to_repair:
+            WorkingShift.update_cache_values(to_repair)
+    return len(working_shifts), drift, missing
+
+
+def _audit_chunk(args):
+    return audit_chunk(*args)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Check the cost cache of the done working shifts")
+    parser.add_argument('-c', '--config', dest='config_file',
+        default=os.environ.get('TRYTOND_CONFIG'), metavar='FILE',
+        help="the trytond configuration file")
+    parser.add_argument('-d', '--database', required=True,
+        help="the database to check")
+    parser.add_argument('--chunk', type=int, default=1000,
+        help="the number of ids checked by each transaction")
+    parser.add_argument('--processes', type=int, default=None,
+        help="the number of processes (default: the number of CPUs)")
+    parser.add_argument('--repair', action='store_true',
+        help="update the cache values of the working shifts that differ "
+        "and are not invoiced")
+    options = parser.parse_args(args)
+
+    init(options.config_file, options.database)
+    chunks = get_chunks(options.database, options.chunk)
+
+    # Spawn the workers to not share the database connections of the parent
+    context = multiprocessing.get_context('spawn')
+    checked = differ = invoiced = without = 0
+    with context.Pool(options.processes, initializer=init,
+            initargs=(options.config_file, options.database)) as pool:
+        for count, drift, missing in pool.imap_unordered(_audit_chunk,
+                [(options.database, f, l, options.repair)
+                    for f, l in chunks]):
+            checked += count
+            differ += len(drift)
+            invoiced += sum(1 for d in drift if d[3])
+            without += len(missing)
+            for ws_id, cached, computed, is_invoiced in drift:
+                print('%s\t%s\t%s\t%s' % (ws_id, cached, computed,
+                        'invoiced' if is_invoiced else ''))
+            for ws_id in missing:
+                print('%s\t\t\tno cache' % ws_id)
+    repaired = differ - invoiced if options.repair else 0
+    print("%s working shifts checked, %s differ (%s invoiced, %s repaired), "
+        "%s without cache" % (checked, differ, invoiced, repaired, without),
+        file=sys.stderr)
+    return 1 if differ - repaired else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,40 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 from decimal import Decimal
-from sql import Literal
-from sql.aggregate import Max
+from weakref import WeakKeyDictionary
 
-from trytond.model import MatchMixin, ModelSQL, ModelView, Workflow, fields
+from sql import Column, Null
+from sql.operators import Equal
+from sql.aggregate import Count, Sum
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import (
+    Exclude, Index, MatchMixin, ModelSQL, ModelView, Unique, Workflow, fields)
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, If
+from trytond.sql.functions import DateRange
+from trytond.sql.operators import RangeOverlap
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.model.exceptions import ValidationError
 from trytond.modules.product import price_digits
+from trytond.tools import grouped_slice, reduce_ids, sql_pairing
+
+from .instrumentation import InstrumentationMixin
 
 STATES = {
     'readonly': Eval('state') != 'draft',
     }
 
+# Confirmed contracts of each employee by transaction
+_employee_intervals = WeakKeyDictionary()
+
 
 class ContractRuleSet(ModelSQL, ModelView):
     '''Payroll Contract Ruleset'''
@@ -27,9 +45,53 @@ class ContractRuleSet(ModelSQL, ModelView):
         fields.Boolean('Compute Interventions'),
         'get_compute_interventions')
 
+    _matcher_cache = Cache('payroll.contract.ruleset.matcher', context=False)
+
     def get_compute_interventions(self, name):
         return any(r.compute_method == 'intervention' for r in self.rules)
 
+    def get_matcher(self):
+        """
+        Return a dictionary with a tuple of sorted hours thresholds and the
+        rule ids that match for each threshold position by compute method.
+        A rule matches when it has no hours or the hours to match are not
+        greater than its hours, and the first rule in order wins.
+        """
+        matcher = self._matcher_cache.get(self.id)
+        if matcher is not None:
+            return matcher
+
+        method_rules = defaultdict(list)
+        for position, rule in enumerate(self.rules):
+            method_rules[rule.compute_method].append(
+                (rule.hours, position, rule.id))
+        matcher = {}
+        for compute_method, rules in method_rules.items():
+            first = min(((p, i) for h, p, i in rules if not h),
+                default=(None, None))
+            rules = sorted((h, p, i) for h, p, i in rules if h)
+            rule_ids = [first[1]]
+            for hours, position, rule_id in reversed(rules):
+                if first[0] is None or position < first[0]:
+                    first = (position, rule_id)
+                rule_ids.append(first[1])
+            rule_ids.reverse()
+            matcher[compute_method] = ([h for h, _, _ in rules], rule_ids)
+        self._matcher_cache.set(self.id, matcher)
+        return matcher
+
+    def compute_matching_rule(self, compute_method, hours):
+        "Return the first rule of compute_method that matches the hours"
+        pool = Pool()
+        Rule = pool.get('payroll.contract.rule')
+        matcher = self.get_matcher()
+        if compute_method not in matcher:
+            return
+        thresholds, rule_ids = matcher[compute_method]
+        rule_id = rule_ids[bisect_left(thresholds, hours or Decimal(0))]
+        if rule_id is not None:
+            return Rule(rule_id)
+
 
 class ContractRule(ModelSQL, ModelView, MatchMixin):
     'Payroll Contract Rule'
@@ -83,6 +145,67 @@ class ContractRule(ModelSQL, ModelView, MatchMixin):
     def default_compute_method():
         return 'working_shift'
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        RuleSet = pool.get('payroll.contract.ruleset')
+        WorkingShift = pool.get('working_shift')
+        RuleSet._matcher_cache.clear()
+        rules = super(ContractRule, cls).create(vlist)
+        WorkingShift.update_cache_values(cls._get_working_shift_cache_ids(
+                [], {r.ruleset.id for r in rules}))
+        return rules
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        RuleSet = pool.get('payroll.contract.ruleset')
+        WorkingShift = pool.get('working_shift')
+        RuleSet._matcher_cache.clear()
+        to_update = []
+        ruleset_ids = set()
+        actions = iter(args)
+        for rules, values in zip(actions, actions):
+            # Any change but the cost price may change the matching rule
+            if values.keys() & {'ruleset', 'sequence', 'compute_method',
+                    'hours'}:
+                ruleset_ids |= {r.ruleset.id for r in rules}
+                if values.get('ruleset'):
+                    ruleset_ids.add(values['ruleset'])
+            elif 'cost_price' in values:
+                to_update.extend(rules)
+        shift_ids = cls._get_working_shift_cache_ids(to_update, ruleset_ids)
+        super(ContractRule, cls).write(*args)
+        WorkingShift.update_cache_values(shift_ids)
+
+    @classmethod
+    def delete(cls, rules):
+        pool = Pool()
+        RuleSet = pool.get('payroll.contract.ruleset')
+        WorkingShift = pool.get('working_shift')
+        RuleSet._matcher_cache.clear()
+        shift_ids = cls._get_working_shift_cache_ids(
+            rules, {r.ruleset.id for r in rules})
+        super(ContractRule, cls).delete(rules)
+        WorkingShift.update_cache_values(shift_ids)
+
+    @classmethod
+    def _get_working_shift_cache_ids(cls, rules, ruleset_ids):
+        """
+        Return the ids of the working shifts whose cache values use the rules
+        or may use a rule of the rulesets
+        """
+        pool = Pool()
+        Contract = pool.get('payroll.contract')
+        WorkingShift = pool.get('working_shift')
+        ranges = []
+        if ruleset_ids:
+            ranges = Contract._get_cache_ranges(Contract.search([
+                        ('ruleset', 'in', list(ruleset_ids)),
+                        ]))
+        return WorkingShift._get_cache_ids(
+            rule_ids=[r.id for r in rules], ranges=ranges)
+
     def match(self, pattern):
         if 'hours' in pattern and self.hours:
             pattern = pattern.copy()
@@ -142,6 +265,25 @@ class Contract(Workflow, ModelSQL, ModelView):
     @classmethod
     def __setup__(cls):
         super(Contract, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(
+                t,
+                (t.employee, Index.Equality()),
+                (t.state, Index.Equality()),
+                (t.start, Index.Range()),
+                (t.end, Index.Range())))
+        if config.getboolean(
+                'payroll', 'contract_overlap_constraint', default=False):
+            # Prevent concurrent transactions from confirming overlapping
+            # contracts on the backends that support it
+            cls._sql_constraints += [
+                ('overlap_exclude', Exclude(t,
+                        (t.employee, Equal),
+                        (DateRange(t.start, t.end, '[]'), RangeOverlap),
+                        where=t.state == 'confirmed'),
+                    'payroll.contract_overlap_exclude'),
+                ]
         cls._order.insert(0, ('start', 'ASC'))
         cls._transitions |= set((
                 ('draft', 'confirmed'),
@@ -178,6 +320,19 @@ class Contract(Workflow, ModelSQL, ModelView):
                 [sql_table.state], ['cancelled'],
                 where=sql_table.state == 'cancel'))
 
+    @classmethod
+    def _update_sql_indexes(cls, concurrently=False):
+        super()._update_sql_indexes(concurrently=concurrently)
+        # Index the date ranges to find overlapping contracts
+        # The Index API can not express GiST indexes so it is created after
+        # the synchronisation with a name that is not dropped by it
+        if backend.name == 'postgresql':
+            cursor = Transaction().connection.cursor()
+            cursor.execute('CREATE INDEX %s IF NOT EXISTS '
+                '"payroll_contract_daterange_gist" ON "%s" USING GIST '
+                '(daterange("start", "end", \'[]\'))'
+                % ('CONCURRENTLY' if concurrently else '', cls._table))
+
     def get_rec_name(self, name):
         return '%s (%s)' % (self.employee.rec_name, self.start)
 
@@ -197,28 +352,45 @@ class Contract(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def validate(cls, contracts):
-        for contract in contracts:
-            contract.check_overlaping_contracts()
+        super(Contract, cls).validate(contracts)
+        cls.check_contracts_overlaping(contracts)
 
     def check_overlaping_contracts(self):
-        if self.state != 'confirmed':
-            return
+        self.check_contracts_overlaping([self])
 
-        domain = [
-            ('id', '!=', self.id),
-            ('employee', '=', self.employee.id),
-            ('state', '=', 'confirmed'),
-            ['OR',
-                ('end', '=', None),
-                ('end', '>=', self.start)],
-            ]
-        if self.end:
-            domain.append(('start', '<=', self.end))
-        overlaping_contracts = self.search(domain)
-        if overlaping_contracts:
-            raise ValidationError(gettext('payroll.overlaping_contract',
-                    current_contract=self.rec_name,
-                    overlaped_contract=overlaping_contracts[0].rec_name ))
+    @classmethod
+    def check_contracts_overlaping(cls, contracts):
+        "Check the confirmed contracts do not overlap with any other"
+        table = cls.__table__()
+        other = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if backend.name == 'postgresql':
+            # Use the GiST index on the date ranges
+            overlap = RangeOverlap(
+                DateRange(table.start, table.end, '[]'),
+                DateRange(other.start, other.end, '[]'))
+        else:
+            overlap = (((other.end == Null) | (other.end >= table.start))
+                & ((table.end == Null) | (other.start <= table.end)))
+        query = table.join(other,
+            condition=(table.employee == other.employee)
+            & (table.id != other.id)
+            & (other.state == 'confirmed')
+            & overlap)
+        ids = [c.id for c in contracts if c.state == 'confirmed']
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*query.select(table.id, other.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.state == 'confirmed'),
+                    order_by=[table.id.asc, other.start.asc],
+                    limit=1))
+            row = cursor.fetchone()
+            if row:
+                contract, overlaped_contract = cls.browse(row)
+                raise ValidationError(gettext('payroll.overlaping_contract',
+                        current_contract=contract.rec_name,
+                        overlaped_contract=overlaped_contract.rec_name))
 
     def _get_working_shift_pattern(self, working_shift, pattern=None):
         if pattern is None:
@@ -230,6 +402,9 @@ class Contract(Workflow, ModelSQL, ModelView):
 
     def compute_working_shift_matching_rule(self, working_shift, pattern=None):
         pattern = self._get_working_shift_pattern(working_shift, pattern)
+        if pattern.keys() == {'hours'}:
+            return self.ruleset.compute_matching_rule('working_shift',
+                pattern['hours'])
         for rule in self.ruleset.rules:
             if rule.compute_method != 'working_shift':
                 continue
@@ -246,6 +421,9 @@ class Contract(Workflow, ModelSQL, ModelView):
 
     def compute_intervention_matching_rule(self, intervention, pattern=None):
         pattern = self._get_intervention_pattern(intervention, pattern)
+        if pattern.keys() == {'hours'}:
+            return self.ruleset.compute_matching_rule('intervention',
+                pattern['hours'])
         for rule in self.ruleset.rules:
             if rule.compute_method != 'intervention':
                 continue
@@ -256,8 +434,7 @@ class Contract(Workflow, ModelSQL, ModelView):
     @ModelView.button
     @Workflow.transition('draft')
     def draft(cls, contracts):
-        for contract in contracts:
-            contract.check_contracts_invoiced_payslips()
+        cls.check_invoiced_payslips(contracts)
 
     @classmethod
     @ModelView.button
@@ -269,21 +446,36 @@ class Contract(Workflow, ModelSQL, ModelView):
     @ModelView.button
     @Workflow.transition('cancelled')
     def cancel(cls, contracts):
-        for contract in contracts:
-            contract.check_contracts_invoiced_payslips()
+        cls.check_invoiced_payslips(contracts)
 
     def check_contracts_invoiced_payslips(self):
+        self.check_invoiced_payslips([self])
+
+    @classmethod
+    def check_invoiced_payslips(cls, contracts):
+        "Check the confirmed contracts have no invoiced payslips"
         pool = Pool()
         Payslip = pool.get('payroll.payslip')
-        if self.state != 'confirmed':
-            return
-        if Payslip.search([
-                ('contract', '=', self),
-                ('supplier_invoice', '!=', None),
-                ('supplier_invoice.state', '!=', 'cancelled'),
-                ]):
-            raise ValidationError(gettext('payroll.contract_with_invoiced_payslips',
-                contract=self.rec_name))
+        Invoice = pool.get('account.invoice')
+        payslip = Payslip.__table__()
+        invoice = Invoice.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = [c.id for c in contracts if c.state == 'confirmed']
+        invoiced = set()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*payslip.join(invoice,
+                    condition=payslip.supplier_invoice == invoice.id
+                    ).select(payslip.contract,
+                    where=reduce_ids(payslip.contract, sub_ids)
+                    & (invoice.state != 'cancelled'),
+                    group_by=payslip.contract))
+            invoiced.update(c for c, in cursor)
+        if invoiced:
+            raise ValidationError(gettext(
+                    'payroll.contract_with_invoiced_payslips',
+                    contract=', '.join(
+                        c.rec_name for c in contracts if c.id in invoiced)))
 
     @classmethod
     def copy(cls, contracts, default=None):
@@ -294,16 +486,99 @@ class Contract(Workflow, ModelSQL, ModelView):
         default['state'] = 'draft'
         return super(Contract, cls).copy(contracts, default=default)
 
+    @classmethod
+    def create(cls, vlist):
+        _employee_intervals.pop(Transaction(), None)
+        return super(Contract, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        WorkingShift = pool.get('working_shift')
+        _employee_intervals.pop(Transaction(), None)
+        to_update, to_refresh = [], []
+        actions = iter(args)
+        for contracts, values in zip(actions, actions):
+            if values.keys() & {'employee', 'start', 'end', 'state',
+                    'ruleset'}:
+                to_update.extend(contracts)
+            # Only the fields used to compute the hours require a refresh
+            if values.keys() & {'employee', 'start', 'end',
+                    'working_shift_hours'}:
+                to_refresh.extend(contracts)
+        # The working shifts of both the old and the new contract ranges
+        shift_ids = WorkingShift._get_cache_ids(
+            ranges=cls._get_cache_ranges(to_update))
+        super(Contract, cls).write(*args)
+        shift_ids |= WorkingShift._get_cache_ids(
+            ranges=cls._get_cache_ranges(to_update))
+        WorkingShift.update_cache_values(shift_ids)
+        if to_refresh:
+            SummaryCache.refresh(SummaryCache._get_contract_keys(
+                    [c.id for c in to_refresh]))
+
+    @staticmethod
+    def _get_cache_ranges(contracts):
+        """
+        Return the (employee id, start, end) ranges of the confirmed contracts
+        that are used to compute the working shift cache values
+        """
+        return [(c.employee.id, c.start, c.end) for c in contracts
+            if c.state == 'confirmed']
+
     @classmethod
     def delete(cls, contracts):
         for contract in contracts:
             if contract.state == 'confirmed':
                 raise UserError(gettext('payroll.delete_confirmed_contract',
                     contract=contract.rec_name))
+        _employee_intervals.pop(Transaction(), None)
         super(Contract, cls).delete(contracts)
 
+    @classmethod
+    def _get_employee_intervals(cls, employee_ids):
+        """
+        Return a dictionary with the confirmed contracts of each employee as
+        a tuple of starts, keys of the maximum end until each contract (as
+        (no end, end) to sort the contracts without end last) and (start, end,
+        contract id) sorted by start.
+        The intervals are kept until the end of the transaction or until a
+        contract is modified.
+        """
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        intervals = _employee_intervals.setdefault(transaction, {})
+        missing = [e for e in employee_ids if e not in intervals]
+        for sub_ids in grouped_slice(missing):
+            sub_ids = list(sub_ids)
+            contracts = {e: [] for e in sub_ids}
+            cursor.execute(*table.select(
+                    table.employee, table.start, table.end, table.id,
+                    where=reduce_ids(table.employee, sub_ids)
+                    & (table.state == 'confirmed'),
+                    order_by=[table.start.asc, table.id.asc]))
+            for employee, start, end, contract_id in cursor:
+                contracts[employee].append((start, end, contract_id))
+            for employee, entries in contracts.items():
+                max_ends = []
+                for _, end, _ in entries:
+                    if max_ends and max_ends[-1] is None:
+                        end = None
+                    elif (end is not None and max_ends
+                            and max_ends[-1] > end):
+                        end = max_ends[-1]
+                    max_ends.append(end)
+                intervals[employee] = (
+                    [e[0] for e in entries],
+                    [(e is None, e or datetime.date.min) for e in max_ends],
+                    entries)
+        return {e: intervals[e] for e in employee_ids}
 
-class ContractHoursSummary(ModelSQL, ModelView):
+
+class ContractHoursSummary(InstrumentationMixin, ModelSQL, ModelView):
     'Payroll Contract Hours Summary'
     __name__ = 'payroll.contract.hours_summary'
     contract = fields.Many2One('payroll.contract', 'Payroll', readonly=True)
@@ -311,117 +586,175 @@ class ContractHoursSummary(ModelSQL, ModelView):
         readonly=True)
     working_hours = fields.Function(fields.Numeric('Working Hours',
             digits=(16, 2)),
-        'get_working_hours')
+        'get_hours')
     worked_hours = fields.Function(fields.Numeric('Worked Hours',
             digits=(16, 2)),
-        'get_worked_hours')
+        'get_hours')
     leave_hours = fields.Function(fields.Numeric('Leave Hours',
             digits=(16, 2)),
-        'get_leave_hours')
+        'get_hours')
     entitled_hours = fields.Function(fields.Numeric('Entitled Hours',
             digits=(16, 2)),
-        'get_entitled_hours')
+        'get_hours')
     hours_to_do = fields.Function(fields.Numeric('Hours To Do',
             digits=(16, 2)),
-        'get_hours_to_do')
+        'get_hours')
     remaining_hours = fields.Function(fields.Numeric('Remaining Hours',
             digits=(16, 2)),
-        'get_remaining_extra_hours')
+        'get_hours')
     extra_hours = fields.Function(fields.Numeric('Extra Hours',
             digits=(16, 2)),
-        'get_remaining_extra_hours')
+        'get_hours')
     leave_payment_hours = fields.Function(fields.Numeric('Leave Payment Hours',
             digits=(16, 2)),
-        'get_leave_payment_hours')
+        'get_hours')
 
     def get_rec_name(self, name):
         return self.leave_period.name
 
-    def get_working_hours(self, name):
+    @classmethod
+    def get_hours(cls, summaries, names):
         pool = Pool()
-        PayslipLine = pool.get('payroll.payslip.line')
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        keys = {s.id: (s.contract.id, s.leave_period.id) for s in summaries}
+        hours = SummaryCache.get_hours(set(keys.values()))
 
-        payslip_lines = PayslipLine.search([
-                ('payslip.employee', '=', self.contract.employee.id),
-                ('payslip.contract', '=', self.contract.id),
-                ('payslip.start', '>=', self.leave_period.start),
-                ('payslip.end', '<=', self.leave_period.end),
-                ])
-        if not payslip_lines:
-            return Decimal('0.00')
-        digits = self.__class__.working_hours.digits
-        return sum(l.working_hours for l in payslip_lines).quantize(
-            Decimal(str(10 ** -digits[1])))
-
-    def get_leave_hours(self, name):
-        Leave = Pool().get('employee.leave')
-        digits = self.__class__.leave_hours.digits
-        return Leave.get_leave_hours(self.contract.employee,
-            self.leave_period.start, self.leave_period.end).quantize(
-                Decimal(str(10 ** -digits[1])))
-
-    def get_hours_to_do(self, name):
-        if not self.working_hours:
-            return Decimal('0.00')
-        digits = self.__class__.hours_to_do.digits
-        return (self.working_hours - self.leave_hours).quantize(
-            Decimal(str(10 ** -digits[1])))
-
-    def get_worked_hours(self, name):
-        pool = Pool()
-        WorkingShift = pool.get('working_shift')
+        def quantize(name, value):
+            digits = getattr(cls, name).digits
+            return value.quantize(Decimal(str(10 ** -digits[1])))
 
-        working_shifts = WorkingShift.search([
-                ('employee', '=', self.contract.employee.id),
-                ('payslip_line.payslip.start', '>=', self.leave_period.start),
-                ('payslip_line.payslip.end', '<=', self.leave_period.end),
-                ('state', '=', 'done'),
-                ('payslip_line.payslip.contract', '=', self.contract.id),
-                ])
-        if not working_shifts:
-            return Decimal('0.00')
-        digits = self.__class__.worked_hours.digits
-        return (len(working_shifts) * self.contract.working_shift_hours
-            ).quantize(Decimal(str(10 ** -digits[1])))
-
-    def get_entitled_hours(self, name):
+        result = {}
+        for name in names:
+            result[name] = {}
+        for summary_id, key in keys.items():
+            values = hours[key].copy()
+            values['hours_to_do'] = Decimal('0.00')
+            if values['working_hours']:
+                values['hours_to_do'] = quantize('hours_to_do',
+                    values['working_hours'] - values['leave_hours'])
+            difference = (values['worked_hours'] - values['hours_to_do']
+                - values['entitled_hours'])
+            values['remaining_hours'] = Decimal('0.00')
+            values['extra_hours'] = Decimal('0.00')
+            if difference < Decimal(0):
+                values['remaining_hours'] = -quantize('remaining_hours',
+                    difference)
+            elif difference > Decimal(0):
+                values['extra_hours'] = quantize('extra_hours', difference)
+            for name in names:
+                result[name][summary_id] = values[name]
+        return result
+
+    @classmethod
+    def _compute_hours(cls, keys):
+        """
+        Return a dictionary with the working, worked, leave, entitled and
+        leave payment hours of each (contract id, leave period id) key
+        computed with one grouped query by table
+        """
         pool = Pool()
+        Contract = pool.get('payroll.contract')
+        LeavePeriod = pool.get('employee.leave.period')
+        Payslip = pool.get('payroll.payslip')
+        PayslipLine = pool.get('payroll.payslip.line')
+        WorkingShift = pool.get('working_shift')
         Entitlement = pool.get('employee.leave.entitlement')
-        entitlements = Entitlement.search([
-                ('employee', '=', self.contract.employee.id),
-                ('period', '=', self.leave_period.id),
-                ('payslip_line.payslip.contract', '=', self.contract.id),
-                ])
-        if not entitlements:
-            return Decimal('0.00')
-        digits = self.__class__.entitled_hours.digits
-        return sum([e.hours for e in entitlements]).quantize(
-            Decimal(str(10 ** -digits[1])))
-
-    def get_remaining_extra_hours(self, name):
-        difference = (self.worked_hours - self.hours_to_do
-            - self.entitled_hours)
-        if name == 'remaining_hours' and difference < Decimal(0):
-            digits = self.__class__.remaining_hours.digits
-            return -difference.quantize(Decimal(str(10 ** -digits[1])))
-        elif name == 'extra_hours' and difference > 0:
-            digits = self.__class__.extra_hours.digits
-            return difference.quantize(Decimal(str(10 ** -digits[1])))
-        return Decimal('0.00')
-
-    def get_leave_payment_hours(self, name):
-        pool = Pool()
         LeavePayment = pool.get('employee.leave.payment')
-        leave_payments = LeavePayment.search([
-                ('employee', '=', self.contract.employee.id),
-                ('period', '=', self.leave_period.id),
-                ('payslip_line.payslip.contract', '=', self.contract.id),
-                ])
-        if not leave_payments:
-            return Decimal('0.00')
-        digits = self.__class__.leave_payment_hours.digits
-        return sum([p.hours for p in leave_payments]).quantize(
-            Decimal(str(10 ** -digits[1])))
+        contract = Contract.__table__()
+        leave_period = LeavePeriod.__table__()
+        payslip = Payslip.__table__()
+        line = PayslipLine.__table__()
+        working_shift = WorkingShift.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def quantize(name, value):
+            if not isinstance(value, Decimal):
+                value = Decimal(str(value))
+            digits = getattr(cls, name).digits
+            return value.quantize(Decimal(str(10 ** -digits[1])))
+
+        names = ['working_hours', 'worked_hours', 'leave_hours',
+            'entitled_hours', 'leave_payment_hours']
+        result = {k: {n: quantize(n, 0) for n in names} for k in keys}
+        period_ids = list({p for _, p in keys})
+        periods = {}
+        for sub_ids in grouped_slice(period_ids):
+            cursor.execute(*leave_period.select(
+                    leave_period.id, leave_period.start, leave_period.end,
+                    where=reduce_ids(leave_period.id, sub_ids)))
+            for period_id, start, end in cursor:
+                periods[period_id] = (start, end)
+
+        contracts = {}
+        for sub_ids in grouped_slice(list({c for c, _ in keys})):
+            sub_ids = list(sub_ids)
+            cursor.execute(*contract.select(
+                    contract.id, contract.employee,
+                    contract.working_shift_hours,
+                    where=reduce_ids(contract.id, sub_ids)))
+            for contract_id, employee, working_shift_hours in cursor:
+                contracts[contract_id] = (employee, working_shift_hours)
+
+            payslip_period = (contract.join(payslip,
+                    condition=(payslip.contract == contract.id)
+                    & (payslip.employee == contract.employee)
+                    ).join(leave_period,
+                    condition=(payslip.start >= leave_period.start)
+                    & (payslip.end <= leave_period.end)))
+            where = (reduce_ids(contract.id, sub_ids)
+                & reduce_ids(leave_period.id, period_ids))
+
+            queries = {
+                'working_hours': payslip_period.join(line,
+                    condition=line.payslip == payslip.id
+                    ).select(contract.id, leave_period.id,
+                    Sum(line.working_hours),
+                    where=where,
+                    group_by=[contract.id, leave_period.id]),
+                'worked_hours': payslip_period.join(line,
+                    condition=line.payslip == payslip.id
+                    ).join(working_shift,
+                    condition=(working_shift.payslip_line == line.id)
+                    & (working_shift.employee == contract.employee)
+                    ).select(contract.id, leave_period.id,
+                    Count(working_shift.id),
+                    where=where & (working_shift.state == 'done'),
+                    group_by=[contract.id, leave_period.id]),
+                }
+            for name, Model in [
+                    ('entitled_hours', Entitlement),
+                    ('leave_payment_hours', LeavePayment),
+                    ]:
+                table = Model.__table__()
+                queries[name] = table.join(line,
+                    condition=table.payslip_line == line.id
+                    ).join(payslip,
+                    condition=line.payslip == payslip.id
+                    ).join(contract,
+                    condition=(payslip.contract == contract.id)
+                    & (table.employee == contract.employee)
+                    ).select(contract.id, table.period, Sum(table.hours),
+                    where=reduce_ids(contract.id, sub_ids)
+                    & reduce_ids(table.period, period_ids),
+                    group_by=[contract.id, table.period])
+
+            for name, query in queries.items():
+                cursor.execute(*query)
+                for contract_id, period_id, value in cursor:
+                    key = (contract_id, period_id)
+                    if key not in result or not value:
+                        continue
+                    if name == 'worked_hours':
+                        value *= contracts[contract_id][1]
+                    result[key][name] = quantize(name, value)
+
+        ranges = {k: (contracts[k[0]][0],) + periods[k[1]] for k in keys
+            if k[0] in contracts and k[1] in periods}
+        range_leaves = Payslip._get_range_leaves(set(ranges.values()))
+        for key, range_ in ranges.items():
+            result[key]['leave_hours'] = quantize('leave_hours',
+                Payslip._get_leaves_hours(range_leaves[range_], *range_[1:]))
+        return result
 
     @classmethod
     def table_query(cls):
@@ -431,12 +764,11 @@ class ContractHoursSummary(ModelSQL, ModelView):
         contract = Contract.__table__()
         leave_period = LeavePeriod.__table__()
 
-        cursor = Transaction().connection.cursor()
-        cursor.execute(*contract.select(Max(contract.id)))
-        max_contract_id, = cursor.fetchone()
-        id_padding = 10 ** len(str(max_contract_id))
-        return (contract + leave_period).select(
-            (contract.id + (Literal(id_padding) * leave_period.id)).as_('id'),
+        return contract.join(leave_period,
+            condition=(leave_period.end >= contract.start)
+            & ((contract.end == Null) | (leave_period.start <= contract.end))
+            ).select(
+            sql_pairing(contract.id, leave_period.id).as_('id'),
             contract.create_uid,
             contract.create_date,
             contract.write_uid,
@@ -445,6 +777,224 @@ class ContractHoursSummary(ModelSQL, ModelView):
             leave_period.id.as_('leave_period'))
 
 
+class ContractHoursSummaryCache(ModelSQL):
+    'Payroll Contract Hours Summary Cache'
+    __name__ = 'payroll.contract.hours_summary.cache'
+    contract = fields.Many2One('payroll.contract', 'Contract', required=True,
+        ondelete='CASCADE')
+    leave_period = fields.Many2One('employee.leave.period', 'Period',
+        required=True, ondelete='CASCADE')
+    working_hours = fields.Numeric('Working Hours', digits=(16, 2))
+    worked_hours = fields.Numeric('Worked Hours', digits=(16, 2))
+    leave_hours = fields.Numeric('Leave Hours', digits=(16, 2))
+    entitled_hours = fields.Numeric('Entitled Hours', digits=(16, 2))
+    leave_payment_hours = fields.Numeric('Leave Payment Hours',
+        digits=(16, 2))
+
+    @classmethod
+    def __setup__(cls):
+        super(ContractHoursSummaryCache, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('contract_leave_period_uniq',
+                Unique(t, t.contract, t.leave_period),
+                'payroll.contract_hours_summary_cache_unique'),
+            ]
+
+    @classmethod
+    def _hours_names(cls):
+        return ['working_hours', 'worked_hours', 'leave_hours',
+            'entitled_hours', 'leave_payment_hours']
+
+    @classmethod
+    def get_hours(cls, keys):
+        """
+        Return a dictionary with the stored hours of each (contract id, leave
+        period id) key. The keys that are not stored are computed.
+        """
+        pool = Pool()
+        Summary = pool.get('payroll.contract.hours_summary')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        names = cls._hours_names()
+        result = {}
+        for sub_keys in grouped_slice(list(keys)):
+            sub_keys = set(sub_keys)
+            cursor.execute(*table.select(table.contract, table.leave_period,
+                    *[Column(table, n) for n in names],
+                    where=reduce_ids(table.contract, {c for c, _ in sub_keys})
+                    & reduce_ids(table.leave_period,
+                        {p for _, p in sub_keys})))
+            for contract_id, period_id, *values in cursor:
+                key = (contract_id, period_id)
+                if key in sub_keys:
+                    result[key] = dict(zip(names, values))
+        missing = set(keys) - set(result)
+        if missing:
+            result.update(Summary._compute_hours(missing))
+        return result
+
+    @classmethod
+    def refresh(cls, keys):
+        "Compute and store the hours of the (contract id, period id) keys"
+        pool = Pool()
+        Summary = pool.get('payroll.contract.hours_summary')
+        for sub_keys in grouped_slice(list(keys)):
+            sub_keys = set(sub_keys)
+            cls.delete([c for c in cls.search([
+                            ('contract', 'in', list({c for c, _ in sub_keys})),
+                            ('leave_period', 'in',
+                                list({p for _, p in sub_keys})),
+                            ])
+                    if (c.contract.id, c.leave_period.id) in sub_keys])
+            hours = Summary._compute_hours(sub_keys)
+            to_create = []
+            for (contract_id, period_id), values in hours.items():
+                values = values.copy()
+                values['contract'] = contract_id
+                values['leave_period'] = period_id
+                to_create.append(values)
+            cls.create(to_create)
+
+    @classmethod
+    def rebuild(cls):
+        "Compute and store the hours of all the contract hours summaries"
+        pool = Pool()
+        Summary = pool.get('payroll.contract.hours_summary')
+        table = cls.__table__()
+        summary = Summary.table_query()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.delete())
+        cursor.execute(*summary.select(summary.contract, summary.leave_period))
+        cls.refresh(cursor.fetchall())
+
+    @classmethod
+    def _get_payslip_keys(cls, payslip_ids):
+        """
+        Return the keys whose hours include the payslips, their lines and
+        the entitlements and leave payments of their lines
+        """
+        pool = Pool()
+        Payslip = pool.get('payroll.payslip')
+        PayslipLine = pool.get('payroll.payslip.line')
+        LeavePeriod = pool.get('employee.leave.period')
+        Entitlement = pool.get('employee.leave.entitlement')
+        LeavePayment = pool.get('employee.leave.payment')
+        payslip = Payslip.__table__()
+        line = PayslipLine.__table__()
+        leave_period = LeavePeriod.__table__()
+        cursor = Transaction().connection.cursor()
+
+        keys = set()
+        for sub_ids in grouped_slice(list(payslip_ids)):
+            sub_ids = list(sub_ids)
+            cursor.execute(*payslip.join(leave_period,
+                    condition=(payslip.start >= leave_period.start)
+                    & (payslip.end <= leave_period.end)
+                    ).select(payslip.contract, leave_period.id,
+                    where=reduce_ids(payslip.id, sub_ids)))
+            keys.update(cursor)
+            for Model in [Entitlement, LeavePayment]:
+                table = Model.__table__()
+                cursor.execute(*table.join(line,
+                        condition=table.payslip_line == line.id
+                        ).join(payslip,
+                        condition=line.payslip == payslip.id
+                        ).select(payslip.contract, table.period,
+                        where=reduce_ids(payslip.id, sub_ids)))
+                keys.update(cursor)
+        return keys
+
+    @classmethod
+    def _get_line_record_keys(cls, Model, ids):
+        """
+        Return the keys whose hours include the records of Model, which are
+        entitlements or leave payments
+        """
+        pool = Pool()
+        Payslip = pool.get('payroll.payslip')
+        PayslipLine = pool.get('payroll.payslip.line')
+        table = Model.__table__()
+        payslip = Payslip.__table__()
+        line = PayslipLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        keys = set()
+        for sub_ids in grouped_slice(list(ids)):
+            cursor.execute(*table.join(line,
+                    condition=table.payslip_line == line.id
+                    ).join(payslip,
+                    condition=line.payslip == payslip.id
+                    ).select(payslip.contract, table.period,
+                    where=reduce_ids(table.id, sub_ids)))
+            keys.update(cursor)
+        return keys
+
+    @classmethod
+    def _get_contract_keys(cls, contract_ids):
+        "Return the keys of the contracts"
+        pool = Pool()
+        Summary = pool.get('payroll.contract.hours_summary')
+        summary = Summary.table_query()
+        cursor = Transaction().connection.cursor()
+
+        keys = set()
+        for sub_ids in grouped_slice(contract_ids):
+            cursor.execute(*summary.select(
+                    summary.contract, summary.leave_period,
+                    where=reduce_ids(summary.contract, sub_ids)))
+            keys.update(cursor)
+        return keys
+
+    @classmethod
+    def _get_period_keys(cls, period_ids):
+        "Return the keys of the leave periods"
+        pool = Pool()
+        Summary = pool.get('payroll.contract.hours_summary')
+        summary = Summary.table_query()
+        cursor = Transaction().connection.cursor()
+
+        keys = set()
+        for sub_ids in grouped_slice(period_ids):
+            cursor.execute(*summary.select(
+                    summary.contract, summary.leave_period,
+                    where=reduce_ids(summary.leave_period, sub_ids)))
+            keys.update(cursor)
+        return keys
+
+    @classmethod
+    def _get_employee_keys(cls, ranges):
+        """
+        Return the keys whose leave hours include the (employee id, start,
+        end) ranges
+        """
+        pool = Pool()
+        Contract = pool.get('payroll.contract')
+        LeavePeriod = pool.get('employee.leave.period')
+        contract = Contract.__table__()
+        leave_period = LeavePeriod.__table__()
+        cursor = Transaction().connection.cursor()
+
+        keys = set()
+        if not ranges:
+            return keys
+        start = min(r[1] for r in ranges)
+        end = max(r[2] for r in ranges)
+        for sub_ids in grouped_slice(list({r[0] for r in ranges})):
+            cursor.execute(*contract.join(leave_period,
+                    condition=(leave_period.end >= contract.start)
+                    & ((contract.end == Null)
+                        | (leave_period.start <= contract.end))
+                    ).select(contract.id, leave_period.id,
+                    where=reduce_ids(contract.employee, sub_ids)
+                    & (leave_period.start <= end)
+                    & (leave_period.end >= start)))
+            keys.update(cursor)
+        return keys
+
+
 class Employee(metaclass=PoolMeta):
     __name__ = 'company.employee'
     payroll_contracts = fields.One2Many('payroll.contract', 'employee',
@@ -454,21 +1004,39 @@ class Employee(metaclass=PoolMeta):
         """
         Return the payroll contract which period is in the supplied period
         """
+        key = (self.id, start_date, end_date)
+        return self.get_payroll_contracts([key])[key]
+
+    @classmethod
+    def get_payroll_contracts(cls, keys):
+        """
+        Return a dictionary with the payroll contract of each (employee,
+        start date, end date) key, which is the first confirmed contract of
+        the employee by start that overlaps the dates, or None.
+        The employee may be an instance or an id.
+        """
         pool = Pool()
         Contract = pool.get('payroll.contract')
-        contracts = Contract.search([
-                ('employee', '=', self.id),
-                ('start', '<=', end_date),
-                ('state', '=', 'confirmed'),
-                ['OR',
-                    ('end', '=', None),
-                    ('end', '>=', start_date),
-                    ],
-                ],
-            order=[('start', 'ASC')],
-            limit=1)
-        if contracts:
-            return contracts[0]
+
+        intervals = Contract._get_employee_intervals(
+            list({int(k[0]) for k in keys}))
+        contract_ids = {}
+        for key in keys:
+            employee, start_date, end_date = key
+            starts, max_end_keys, entries = intervals[int(employee)]
+            contract_ids[key] = None
+            # Contracts with start after end_date are not candidates and
+            # max_end_keys is sorted, being no end the greatest value
+            stop = bisect_right(starts, end_date)
+            index = bisect_left(max_end_keys, (False, start_date), 0, stop)
+            for start, end, contract_id in entries[index:stop]:
+                if end is None or end >= start_date:
+                    contract_ids[key] = contract_id
+                    break
+
+        contracts = {c.id: c for c in Contract.browse(
+                list({i for i in contract_ids.values() if i is not None}))}
+        return {k: contracts.get(i) for k, i in contract_ids.items()}
 
     @classmethod
     def copy(cls, employees, default=None):
@@ -0,0 +1,233 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import inspect
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from sql.functions import CurrentTimestamp
+
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+# Calls, duration and SQL statements of the instrumented methods by name and
+# by database name
+_totals = defaultdict(lambda: defaultdict(lambda: [0, 0., 0]))
+_lock = threading.Lock()
+_last_flush = defaultdict(time.monotonic)
+
+
+class QueryCounter(object):
+    "Number of SQL statements executed"
+
+    def __init__(self):
+        self.count = 0
+
+
+class _CountingCursor(object):
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingConnection(object):
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the SQL statements executed with the connection of the current
+    transaction until the end of the block
+    """
+    transaction = Transaction()
+    counter = QueryCounter()
+    connection = transaction.connection
+    transaction.connection = _CountingConnection(connection, counter)
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+def is_enabled():
+    "Return if the instrumentation is enabled by configuration or context"
+    return bool(config.getboolean('payroll', 'instrumentation', default=False)
+        or Transaction().context.get('payroll_instrumentation'))
+
+
+def record(name, duration, queries):
+    "Add a call of the method name to the totals of the current database"
+    logger.debug("%s: %.6fs, %s queries", name, duration, queries)
+    database = Transaction().database.name
+    interval = config.getint(
+        'payroll', 'instrumentation_flush_interval', default=60)
+    with _lock:
+        totals = _totals[database][name]
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] += queries
+        now = time.monotonic()
+        to_flush = now - _last_flush[database] >= interval
+        if to_flush:
+            _last_flush[database] = now
+    if to_flush:
+        # Never let the statistics fail or hide the result of the call
+        try:
+            flush()
+        except Exception:
+            logger.exception("Fail to flush the payroll instrumentation")
+
+
+def flush():
+    """
+    Log the totals of the current database, add them to its stored
+    statistics and reset them
+    """
+    pool = Pool()
+    Stat = pool.get('payroll.instrumentation.stat')
+    database = Transaction().database.name
+    with _lock:
+        totals = {n: tuple(t)
+            for n, t in _totals.pop(database, {}).items()}
+    if not totals:
+        return
+    for name, (calls, duration, queries) in sorted(totals.items()):
+        logger.info("%s: %s calls, %.3fs, %s queries",
+            name, calls, duration, queries)
+    # Use a new transaction to not depend on the one being instrumented
+    with Transaction().new_transaction():
+        Stat.add(totals)
+
+
+def instrument(name, func):
+    "Return func wrapped to record its calls as name when enabled"
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_enabled():
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        with count_queries() as counter:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - started, counter.count)
+    wrapper._payroll_instrumented = True
+    return wrapper
+
+
+class InstrumentationMixin(object):
+    """
+    Instrument the getters of the Function fields and the methods listed in
+    _instrumented_methods
+    """
+    _instrumented_methods = ()
+
+    @classmethod
+    def __post_setup__(cls):
+        super().__post_setup__()
+        names = {f.getter for f in cls._fields.values()
+            if isinstance(f, fields.Function) and f.getter}
+        names.update(cls._instrumented_methods)
+        for name in sorted(names):
+            attr = inspect.getattr_static(cls, name, None)
+            if attr is None or isinstance(attr, staticmethod):
+                continue
+            if isinstance(attr, classmethod):
+                func = attr.__func__
+            else:
+                func = attr
+            if getattr(func, '_payroll_instrumented', False):
+                continue
+            func = instrument('%s.%s' % (cls.__name__, name), func)
+            if isinstance(attr, classmethod):
+                func = classmethod(func)
+            setattr(cls, name, func)
+
+
+class InstrumentationStat(ModelSQL, ModelView):
+    'Payroll Instrumentation Statistic'
+    __name__ = 'payroll.instrumentation.stat'
+    _rec_name = 'method'
+    method = fields.Char('Method', required=True, readonly=True)
+    calls = fields.Integer('Calls', readonly=True)
+    duration = fields.Float('Duration', readonly=True,
+        help="Total wall time in seconds.")
+    queries = fields.Integer('Queries', readonly=True,
+        help="Total number of SQL statements.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order = [
+            ('duration', 'DESC'),
+            ('method', 'ASC'),
+            ]
+
+    @classmethod
+    def add(cls, totals):
+        """
+        Add the totals of (calls, duration, queries) by method name to the
+        statistics
+        """
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        cursor.execute(*table.select(table.method, table.id,
+                where=table.method.in_(list(totals))))
+        ids = dict(cursor)
+        to_create = []
+        for name, (calls, duration, queries) in totals.items():
+            if name not in ids:
+                to_create.append([name, calls, duration, queries,
+                        transaction.user, CurrentTimestamp()])
+                continue
+            cursor.execute(*table.update(
+                    [table.calls, table.duration, table.queries],
+                    [table.calls + calls, table.duration + duration,
+                        table.queries + queries],
+                    where=table.id == ids[name]))
+        if to_create:
+            cursor.execute(*table.insert(
+                    [table.method, table.calls, table.duration,
+                        table.queries, table.create_uid, table.create_date],
+                    to_create))
@@ -0,0 +1,17 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('payroll.contract.hours_summary.cache|rebuild',
+                    "Rebuild Payroll Contract Hours Summary"),
+                ('working_shift|backfill_cost_cache',
+                    "Fill Working Shift Cost Cache"),
+                ])
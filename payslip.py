@@ -1,17 +1,31 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from datetime import datetime
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
 from decimal import Decimal
-from trytond.model import ModelSQL, ModelView, Workflow, fields
-from trytond.pyson import Bool, Date, Eval
+from time import monotonic
+from sql import Literal, Null
+from sql.aggregate import Count, Sum
+from sql.functions import CurrentTimestamp
+
+from trytond.model import Index, ModelSQL, ModelView, Workflow, fields
+from trytond.wizard import Button, StateAction, StateView, Wizard
+from trytond.pyson import Bool, Date, Eval, PYSONEncoder
 from trytond.pool import Pool, PoolMeta
-from trytond.tools import grouped_slice
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond import backend
+from trytond.config import config
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.model.exceptions import ValidationError
 from trytond.modules.currency.fields import Monetary
+from trytond.modules.product import price_digits
+
+from .instrumentation import InstrumentationMixin
+
+logger = logging.getLogger(__name__)
 
 STATES = {
     'readonly': Eval('supplier_invoice_state').in_(
@@ -19,6 +33,23 @@ STATES = {
     }
 
 
+def clear_records_cache(Model, ids=None):
+    """
+    Remove from the transaction cache the records updated with SQL or all the
+    records of Model if ids is None
+    """
+    transaction = Transaction()
+    transaction.counter += 1
+    for cache in transaction.cache.values():
+        if Model.__name__ in cache:
+            cache_model = cache[Model.__name__]
+            if ids is None:
+                cache_model.clear()
+                continue
+            for id_ in ids:
+                cache_model.pop(id_, None)
+
+
 class PayslipLineType(ModelSQL, ModelView):
     'Payslip Line Type'
     __name__ = 'payroll.payslip.line.type'
@@ -26,9 +57,10 @@ class PayslipLineType(ModelSQL, ModelView):
     product = fields.Many2One('product.product', 'Product', required=True)
 
 
-class Payslip(ModelSQL, ModelView):
+class Payslip(InstrumentationMixin, ModelSQL, ModelView):
     'Payslip'
     __name__ = 'payroll.payslip'
+    _instrumented_methods = ('create_supplier_invoices',)
     employee = fields.Many2One('company.employee', 'Employee', required=True,
         states={
             'readonly': Bool(Eval('lines')),
@@ -104,6 +136,15 @@ class Payslip(ModelSQL, ModelView):
     @classmethod
     def __setup__(cls):
         super(Payslip, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.employee, Index.Equality()),
+                    (t.start, Index.Range()),
+                    (t.end, Index.Range())),
+                Index(t, (t.supplier_invoice, Index.Equality())),
+                })
         cls._buttons.update({
                 'create_supplier_invoices': {
                     'readonly': Eval('supplier_invoice_state').in_(
@@ -148,46 +189,127 @@ class Payslip(ModelSQL, ModelView):
 
     @classmethod
     def get_lines_relations(cls, records, names):
+        pool = Pool()
+        PayslipLine = pool.get('payroll.payslip.line')
+        line = PayslipLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = [r.id for r in records]
         result = {}
         for name in names:
-            result[name] = {}
-        for sub_records in grouped_slice(records):
-            for record in sub_records:
-                for name in names:
-                    result[name][record.id] = [p.id for l in record.lines
-                        for p in getattr(l, name, [])]
+            field = PayslipLine._fields[name]
+            target = pool.get(field.model_name).__table__()
+            result[name] = {i: [] for i in ids}
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*target.join(line,
+                        condition=getattr(target, field.field) == line.id
+                        ).select(line.payslip, target.id,
+                        where=reduce_ids(line.payslip, sub_ids),
+                        order_by=[line.id, target.id]))
+                for payslip_id, target_id in cursor:
+                    result[name][payslip_id].append(target_id)
         return result
 
-    def get_leaves(self, name):
-        # Search on 'employee.leave' and find the number of hours that fit
-        # inside this payslip
-        Leave = Pool().get('employee.leave')
-        return [l.id for l in Leave.get_leaves(self.employee, self.start,
-                self.end)]
+    @classmethod
+    def get_leaves(cls, payslips, name):
+        # Search on 'employee.leave' the leaves of all the employees at once
+        # and give to each payslip the ones that overlap its dates
+        range_leaves = cls._get_range_leaves({
+                (p.employee.id, p.start, p.end) for p in payslips})
+        return {
+            p.id: [l.id for l in range_leaves[(p.employee.id, p.start, p.end)]]
+            for p in payslips}
+
+    @classmethod
+    def _get_lines_payslip(cls, payslips):
+        "Return a dictionary with the payslip id of each line of payslips"
+        PayslipLine = Pool().get('payroll.payslip.line')
+        line = PayslipLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        line2payslip = {}
+        for sub_ids in grouped_slice([p.id for p in payslips]):
+            cursor.execute(*line.select(line.id, line.payslip,
+                    where=reduce_ids(line.payslip, sub_ids)))
+            line2payslip.update(cursor)
+        return line2payslip
 
     @classmethod
     def get_lines_hours(cls, records, names):
+        PayslipLine = Pool().get('payroll.payslip.line')
+
+        ids = [r.id for r in records]
+        line2payslip = cls._get_lines_payslip(records)
+        lines_hours = PayslipLine.get_hours(
+            PayslipLine.browse(list(line2payslip)), names)
+
         result = {}
         for name in names:
-            result[name] = {}
-        for sub_records in grouped_slice(records):
-            for record in sub_records:
-                for name in names:
-                    digits = getattr(cls, name).digits
-                    result[name][record.id] = sum((getattr(l, name, Decimal(0))
-                            for l in record.lines), Decimal(0)).quantize(
-                                Decimal(str(10 ** -digits[1])))
+            digits = getattr(cls, name).digits
+            result[name] = dict.fromkeys(ids, Decimal(0))
+            for line_id, hours in lines_hours[name].items():
+                result[name][line2payslip[line_id]] += hours
+            for payslip_id, hours in result[name].items():
+                result[name][payslip_id] = hours.quantize(
+                    Decimal(str(10 ** -digits[1])))
         return result
 
+    @classmethod
+    def _get_range_leaves(cls, ranges):
+        """
+        Return a dictionary with the done leaves that overlap each of the
+        (employee id, start, end) ranges
+        """
+        Leave = Pool().get('employee.leave')
+
+        result = {r: [] for r in ranges}
+        if not ranges:
+            return result
+        employee_ranges = defaultdict(list)
+        for range_ in ranges:
+            employee_ranges[range_[0]].append(range_)
+        start = min(r[1] for r in ranges)
+        end = max(r[2] for r in ranges)
+        for employee_ids in grouped_slice(list(employee_ranges)):
+            leaves = Leave.search([
+                    ('employee', 'in', list(employee_ids)),
+                    ('state', '=', 'done'),
+                    ('start', '<=', end),
+                    ('end', '>=', start),
+                    ])
+            for leave in leaves:
+                for range_ in employee_ranges[leave.employee.id]:
+                    _, range_start, range_end = range_
+                    if leave.start <= range_end and leave.end >= range_start:
+                        result[range_].append(leave)
+        return result
+
+    @staticmethod
+    def _get_leaves_hours(leaves, start, end):
+        "Return the hours of leaves that fit inside start and end dates"
+        hours = Decimal(0)
+        for leave in leaves:
+            leave_days = (leave.end - leave.start).days + 1
+            days = (min(end, leave.end) - max(start, leave.start)).days + 1
+            hours += leave.hours * days / leave_days
+        return hours
+
     @fields.depends('employee', '_parent_employee.company')
     def on_change_with_currency(self, name=None):
         if self.employee:
             return self.employee.company.currency.id
 
-    def get_amount(self, name):
-        if not self.lines:
-            return Decimal(0)
-        return sum([x.amount for x in self.lines])
+    @classmethod
+    def get_amount(cls, payslips, name):
+        PayslipLine = Pool().get('payroll.payslip.line')
+
+        line2payslip = cls._get_lines_payslip(payslips)
+        lines_amount = PayslipLine.get_amount(
+            PayslipLine.browse(list(line2payslip)), name)
+        amounts = dict.fromkeys((p.id for p in payslips), Decimal(0))
+        for line_id, amount in lines_amount.items():
+            amounts[line2payslip[line_id]] += amount
+        return amounts
 
     def get_supplier_invoice_state(self, name):
         return self.supplier_invoice.state if self.supplier_invoice else 'draft'
@@ -203,52 +325,68 @@ class Payslip(ModelSQL, ModelView):
     def create_supplier_invoices(cls, payslips):
         pool = Pool()
         Invoice = pool.get('account.invoice')
+        PayslipLine = pool.get('payroll.payslip.line')
 
-        to_write = []
+        groups = defaultdict(list)
         for payslip in payslips:
             if (payslip.supplier_invoice
                     and payslip.supplier_invoice.state
                     in ('validated', 'posted', 'paid')):
                 continue
+            groups[(payslip.employee.party.id, payslip.end)].append(payslip)
+
+        # Browse all the lines together so their amounts are computed at once
+        payslip_lines = defaultdict(list)
+        for line in PayslipLine.browse([l.id for g in groups.values()
+                    for p in g for l in p.lines]):
+            payslip_lines[line.payslip.id].append(line)
+
+        lookup = cls._get_supplier_invoice_lookup(
+            [p for g in groups.values() for p in g])
+        invoices = []
+        payslip_invoices = []
+        for group in groups.values():
+            invoice = group[0].get_supplier_invoice(lookup=lookup)
+            for payslip in group:
+                if getattr(invoice, 'lines', []):
+                    raise UserError(gettext(
+                            'payroll.payslip_invoice_with_lines',
+                            payslip=payslip.rec_name,
+                            invoice=invoice.rec_name))
+
+                invoice_lines = []
+                for line in payslip_lines[payslip.id]:
+                    invoice_line = line.get_supplier_invoice_line()
+                    if invoice_line:
+                        invoice_lines.append(invoice_line)
+                if not invoice_lines:
+                    continue
+
+                invoice.lines = invoice_lines
+                invoices.append(invoice)
+                payslip_invoices.append((payslip, invoice))
+
+        if not invoices:
+            return
+        Invoice.save(invoices)
+        Invoice.update_taxes(invoices)
 
-            invoice = payslip.get_supplier_invoice()
-            if getattr(invoice, 'lines', []):
-                raise UserError(gettext('payroll.payslip_invoice_with_lines',
-                        payslip=payslip.rec_name,
-                        invoice=invoice.rec_name))
-
-            invoice_lines = []
-            for line in payslip.lines:
-                invoice_line = line.get_supplier_invoice_line()
-                if invoice_line:
-                    invoice_lines.append(invoice_line)
-            if not invoice_lines:
-                continue
-
-            invoice.lines = invoice_lines
-            invoice.save()
-
-            Invoice.update_taxes([invoice])
-
+        to_write = []
+        for payslip, invoice in payslip_invoices:
             to_write.extend(([payslip], {'supplier_invoice': invoice.id}))
+        cls.write(*to_write)
 
-        if to_write:
-            cls.write(*to_write)
-
-    def get_supplier_invoice(self):
+    @classmethod
+    def _get_supplier_invoice_lookup(cls, payslips):
+        """
+        Return the values shared by all the payslips of an invoicing run:
+        the expense journal, the draft supplier invoices by (party id,
+        invoice date) and the invoice values of each party
+        """
         pool = Pool()
         Invoice = pool.get('account.invoice')
         Journal = pool.get('account.journal')
 
-        invoices = Invoice.search([
-                ('type', '=', 'in'),
-                ('party', '=', self.employee.party.id),
-                ('invoice_date', '=', self.end),
-                ('state', '=', 'draft'),
-                ])
-        if invoices:
-            return invoices[0]
-
         journals = Journal.search([
                 ('type', '=', 'expense'),
                 ], limit=1)
@@ -257,36 +395,219 @@ class Payslip(ModelSQL, ModelView):
         else:
             journal = None
 
-        invoice_address = self.employee.party.address_get(type='invoice')
-        payment_term = self.employee.party.supplier_payment_term
+        invoices = {}
+        dates = list({p.end for p in payslips})
+        party_ids = list({p.employee.party.id for p in payslips})
+        for sub_ids in grouped_slice(party_ids):
+            for invoice in Invoice.search([
+                        ('type', '=', 'in'),
+                        ('party', 'in', list(sub_ids)),
+                        ('invoice_date', 'in', dates),
+                        ('state', '=', 'draft'),
+                        ]):
+                invoices.setdefault(
+                    (invoice.party.id, invoice.invoice_date), invoice)
+        return {
+            'journal': journal,
+            'invoices': invoices,
+            'parties': {},
+            }
+
+    def get_supplier_invoice(self, lookup=None):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        if lookup is None:
+            lookup = self._get_supplier_invoice_lookup([self])
+        party = self.employee.party
+        key = (party.id, self.end)
+        if key in lookup['invoices']:
+            return lookup['invoices'][key]
+
+        if party.id not in lookup['parties']:
+            lookup['parties'][party.id] = {
+                'invoice_address': party.address_get(type='invoice'),
+                'account': party.account_payable,
+                'payment_term': party.supplier_payment_term,
+                }
+            if hasattr(Invoice, 'payment_type'):
+                lookup['parties'][party.id]['payment_type'] = (
+                    party.supplier_payment_type)
 
         invoice = Invoice(
             type='in',
-            journal=journal,
+            journal=lookup['journal'],
             invoice_date=self.end,
-            party=self.employee.party,
-            invoice_address=invoice_address,
-            account=self.employee.party.account_payable,
-            payment_term=payment_term,
-            )
-
-        if hasattr(Invoice, 'payment_type'):
-            invoice.payment_type = self.employee.party.supplier_payment_type
-            if hasattr(Invoice, 'bank_account') and invoice.payment_type:
-                invoice.on_change_payment_type()
+            party=party,
+            **lookup['parties'][party.id])
+        if (hasattr(Invoice, 'bank_account')
+                and getattr(invoice, 'payment_type', None)):
+            invoice.on_change_payment_type()
+        lookup['invoices'][key] = invoice
         return invoice
 
+    @classmethod
+    def generate_payslips(cls, start, end, line_type, working_hours,
+            employees=None):
+        """
+        Create the payslips between start and end for the employees (all by
+        default) with a confirmed contract covering the period and attach to
+        them the done working shifts, generated entitlements and leave
+        payments of the period that are not in any payslip yet.
+        Employees that already have a payslip in the period are skipped.
+        Return the list of created payslips.
+        """
+        pool = Pool()
+        Contract = pool.get('payroll.contract')
+        WorkingShift = pool.get('working_shift')
+
+        domain = [
+            ('state', '=', 'confirmed'),
+            ('start', '<=', start),
+            ['OR',
+                ('end', '=', None),
+                ('end', '>=', end),
+                ],
+            ]
+        if employees is not None:
+            employee_ids = [e.id for e in employees]
+        else:
+            employee_ids = list({c.employee.id for c in Contract.search(
+                        domain, order=[])})
+
+        payslips = []
+        for sub_ids in grouped_slice(sorted(employee_ids)):
+            sub_ids = list(sub_ids)
+            existing = {p.employee.id for p in cls.search([
+                        ('employee', 'in', sub_ids),
+                        ('start', '<=', end),
+                        ('end', '>=', start),
+                        ], order=[])}
+            contracts = {}
+            for contract in Contract.search(domain + [
+                        ('employee', 'in', sub_ids),
+                        ], order=[('start', 'DESC')]):
+                contracts[contract.employee.id] = contract
+
+            to_create = []
+            for employee_id in sub_ids:
+                if employee_id in existing or employee_id not in contracts:
+                    continue
+                to_create.append({
+                        'employee': employee_id,
+                        'contract': contracts[employee_id].id,
+                        'start': start,
+                        'end': end,
+                        'lines': [('create', [{
+                                        'type': line_type.id,
+                                        'working_hours': working_hours,
+                                        }])],
+                        })
+            if not to_create:
+                continue
+            created = cls.create(to_create)
+            shift_ids = cls._attach_line_records(created, start, end)
+            WorkingShift.set_cache_values(WorkingShift.browse(shift_ids))
+            payslips.extend(created)
+        return payslips
+
+    @classmethod
+    def _attach_line_records(cls, payslips, start, end):
+        """
+        Set the payslip line of the done working shifts, entitlements and
+        leave payments of the payslip employees between start and end which
+        are not in any payslip. Each payslip must have only one line.
+        Return the ids of the attached working shifts.
+        """
+        pool = Pool()
+        PayslipLine = pool.get('payroll.payslip.line')
+        WorkingShift = pool.get('working_shift')
+        Entitlement = pool.get('employee.leave.entitlement')
+        LeavePayment = pool.get('employee.leave.payment')
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        line = PayslipLine.__table__()
+        payslip = cls.__table__()
+        working_shift = WorkingShift.__table__()
+        entitlement = Entitlement.__table__()
+        leave_payment = LeavePayment.__table__()
+
+        payslip_ids = [p.id for p in payslips]
+        employee_ids = [p.employee.id for p in payslips]
+
+        def line_query(table):
+            return line.join(payslip,
+                condition=line.payslip == payslip.id
+                ).select(line.id,
+                where=(payslip.employee == table.employee)
+                & reduce_ids(payslip.id, payslip_ids))
+
+        cursor.execute(*working_shift.update(
+                [working_shift.payslip_line, working_shift.write_uid,
+                    working_shift.write_date],
+                [line_query(working_shift), transaction.user,
+                    CurrentTimestamp()],
+                where=reduce_ids(working_shift.employee, employee_ids)
+                & (working_shift.state == 'done')
+                & (working_shift.payslip_line == Null)
+                & (working_shift.start >= datetime.combine(start, time.min))
+                & (working_shift.start < datetime.combine(
+                        end + timedelta(days=1), time.min))))
+        for table in (entitlement, leave_payment):
+            cursor.execute(*table.update(
+                    [table.payslip_line, table.write_uid, table.write_date],
+                    [line_query(table), transaction.user,
+                        CurrentTimestamp()],
+                    where=reduce_ids(table.employee, employee_ids)
+                    & (table.payslip_line == Null)
+                    & (table.date >= start)
+                    & (table.date <= end)))
+        clear_records_cache(Entitlement)
+        clear_records_cache(LeavePayment)
+
+        shift_ids = []
+        for sub_ids in grouped_slice(payslip_ids):
+            cursor.execute(*working_shift.join(line,
+                    condition=working_shift.payslip_line == line.id
+                    ).select(working_shift.id,
+                    where=reduce_ids(line.payslip, sub_ids)))
+            shift_ids.extend(i for i, in cursor)
+        clear_records_cache(WorkingShift, shift_ids)
+        SummaryCache.refresh(SummaryCache._get_payslip_keys(payslip_ids))
+        return shift_ids
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        # Only the fields used to compute the hours require a refresh
+        payslip_ids = []
+        actions = iter(args)
+        for payslips, values in zip(actions, actions):
+            if values.keys() & {'employee', 'contract', 'start', 'end'}:
+                payslip_ids.extend(p.id for p in payslips)
+        keys = SummaryCache._get_payslip_keys(payslip_ids)
+        super(Payslip, cls).write(*args)
+        if payslip_ids:
+            SummaryCache.refresh(
+                keys | SummaryCache._get_payslip_keys(payslip_ids))
+
     @classmethod
     def delete(cls, payslips):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
         for payslip in payslips:
             if (payslip.supplier_invoice
                     and payslip.supplier_invoice.state != 'cancelled'):
                 raise UserError(gettext('payroll.delete_invoiced_payslip',
                     payslip=payslip.rec_name))
+        keys = SummaryCache._get_payslip_keys([p.id for p in payslips])
         super(Payslip, cls).delete(payslips)
+        SummaryCache.refresh(keys)
 
 
-class PayslipLine(ModelSQL, ModelView):
+class PayslipLine(InstrumentationMixin, ModelSQL, ModelView):
     'Payslip Line'
     __name__ = 'payroll.payslip.line'
     payslip = fields.Many2One('payroll.payslip', 'Payslip', required=True,
@@ -325,33 +646,33 @@ class PayslipLine(ModelSQL, ModelView):
             states={
                 'invisible': ~Bool(Eval('working_hours', 0)),
                 }),
-        'get_leave_hours')
+        'get_hours')
     hours_to_do = fields.Function(fields.Numeric('Hours To Do', digits=(16, 2),
             states={
                 'invisible': ~Bool(Eval('working_hours', 0)),
                 }),
-        'get_hours_to_do')
+        'get_hours')
     worked_hours = fields.Function(fields.Numeric('Worked Hours',
             digits=(16, 2)),
-        'get_worked_hours')
+        'get_hours')
     generated_entitled_hours = fields.Function(
         fields.Numeric('Generated Entitled Hours', digits=(16, 2), states={
                 'invisible': ~Bool(Eval('working_hours', 0)),
                 }),
-        'get_generated_entitled_hours')
+        'get_hours')
     remaining_hours = fields.Function(fields.Numeric('Remaining Hours',
             digits=(16, 2), states={
                 'invisible': ~Eval('working_hours', 0),
                 }),
-        'get_remaining_extra_hours')
+        'get_hours')
     extra_hours = fields.Function(fields.Numeric('Extra Hours',
             digits=(16, 2)),
-        'get_remaining_extra_hours')
+        'get_hours')
     leave_payment_hours = fields.Function(fields.Numeric('Leave Payment Hours',
             digits=(16, 2), states={
                 'invisible': ~Bool(Eval('working_hours', 0)),
                 }),
-        'get_leave_payment_hours')
+        'get_hours')
     currency = fields.Function(fields.Many2One('currency.currency', 'Currency'),
         'on_change_with_currency')
     amount = fields.Function(Monetary('Amount',
@@ -371,62 +692,110 @@ class PayslipLine(ModelSQL, ModelView):
     # should have to decide how many of the total number of holidays the
     # employee has consumed should go to each line type. As it is not
     # a requirement in this case, we just don't implement that
-    def get_leave_hours(self, name):
-        # Search on 'employee.leave' and find the number of hours that fit
-        # inside this payslip
-        Leave = Pool().get('employee.leave')
-        digits = self.__class__.leave_hours.digits
-        if self.working_hours:
-            return Leave.get_leave_hours(
-                self.payslip.employee, self.payslip.start, self.payslip.end
-                ).quantize(Decimal(str(10 ** -digits[1])))
-        return Decimal(0)
-
-    def get_hours_to_do(self, name):
-        if not self.working_hours:
-            return Decimal(0)
-        digits = self.__class__.hours_to_do.digits
-        return (self.working_hours - self.leave_hours).quantize(
-            Decimal(str(10 ** -digits[1])))
-
-    def get_worked_hours(self, name):
-        digits = self.__class__.worked_hours.digits
-        if not self.working_shifts:
-            return Decimal(0)
-        return (len(self.working_shifts)
-            * self.payslip.contract.working_shift_hours).quantize(
-                Decimal(str(10 ** -digits[1])))
-
-    def get_generated_entitled_hours(self, name):
-        if not self.working_hours:
-            return Decimal(0)
-        digits = self.__class__.generated_entitled_hours.digits
-        if not self.generated_entitlements:
-            return Decimal(0)
-        return sum([x.hours for x in self.generated_entitlements]).quantize(
-            Decimal(str(10 ** -digits[1])))
-
-    def get_remaining_extra_hours(self, name):
-        if not self.working_hours and name == 'remaining_hours':
-            return Decimal(0)
-        difference = (self.worked_hours - self.hours_to_do
-            - self.generated_entitled_hours)
-        if name == 'remaining_hours' and difference < Decimal(0):
-            digits = self.__class__.remaining_hours.digits
-            return -difference.quantize(Decimal(str(10 ** -digits[1])))
-        elif name == 'extra_hours' and difference > 0:
-            digits = self.__class__.extra_hours.digits
-            return difference.quantize(Decimal(str(10 ** -digits[1])))
-        return Decimal(0)
+    @classmethod
+    def get_hours(cls, lines, names):
+        pool = Pool()
+        Payslip = pool.get('payroll.payslip')
+        Contract = pool.get('payroll.contract')
+        WorkingShift = pool.get('working_shift')
+        Entitlement = pool.get('employee.leave.entitlement')
+        LeavePayment = pool.get('employee.leave.payment')
+        line = cls.__table__()
+        payslip = Payslip.__table__()
+        contract = Contract.__table__()
+        working_shift = WorkingShift.__table__()
+        entitlement = Entitlement.__table__()
+        leave_payment = LeavePayment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def quantize(name, value):
+            if not isinstance(value, Decimal):
+                value = Decimal(str(value))
+            digits = getattr(cls, name).digits
+            return value.quantize(Decimal(str(10 ** -digits[1])))
+
+        ids = [l.id for l in lines]
+        values = {}
+        shifts = {}
+        entitled_hours = {}
+        payment_hours = {}
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*line.join(payslip,
+                    condition=line.payslip == payslip.id
+                    ).join(contract,
+                    condition=payslip.contract == contract.id
+                    ).select(line.id, line.working_hours, payslip.employee,
+                    payslip.start, payslip.end,
+                    contract.working_shift_hours,
+                    where=reduce_ids(line.id, sub_ids)))
+            for line_id, *line_values in cursor:
+                values[line_id] = line_values
+
+            cursor.execute(*working_shift.select(
+                    working_shift.payslip_line, Count(Literal('*')),
+                    where=reduce_ids(working_shift.payslip_line, sub_ids),
+                    group_by=working_shift.payslip_line))
+            shifts.update(cursor)
+
+            cursor.execute(*entitlement.select(
+                    entitlement.payslip_line, Sum(entitlement.hours),
+                    where=reduce_ids(entitlement.payslip_line, sub_ids),
+                    group_by=entitlement.payslip_line))
+            entitled_hours.update(cursor)
+
+            cursor.execute(*leave_payment.select(
+                    leave_payment.payslip_line, Sum(leave_payment.hours),
+                    where=reduce_ids(leave_payment.payslip_line, sub_ids),
+                    group_by=leave_payment.payslip_line))
+            payment_hours.update(cursor)
+
+        range_leaves = Payslip._get_range_leaves({
+                (employee, start, end)
+                for working_hours, employee, start, end, _ in values.values()
+                if working_hours})
 
-    def get_leave_payment_hours(self, name):
-        if not self.working_hours:
-            return Decimal(0)
-        digits = self.__class__.leave_payment_hours.digits
-        if not self.leave_payments:
-            return Decimal(0)
-        return sum([p.hours for p in self.leave_payments]).quantize(
-                Decimal(str(10 ** -digits[1])))
+        result = {}
+        for name in names:
+            result[name] = {}
+        for line_id, (working_hours, employee, start, end,
+                working_shift_hours) in values.items():
+            hours = {
+                'leave_hours': Decimal(0),
+                'hours_to_do': Decimal(0),
+                'worked_hours': Decimal(0),
+                'generated_entitled_hours': Decimal(0),
+                'leave_payment_hours': Decimal(0),
+                }
+            if working_hours:
+                hours['leave_hours'] = quantize('leave_hours',
+                    Payslip._get_leaves_hours(
+                        range_leaves[(employee, start, end)], start, end))
+                hours['hours_to_do'] = quantize('hours_to_do',
+                    working_hours - hours['leave_hours'])
+                if entitled_hours.get(line_id):
+                    hours['generated_entitled_hours'] = quantize(
+                        'generated_entitled_hours', entitled_hours[line_id])
+                if payment_hours.get(line_id):
+                    hours['leave_payment_hours'] = quantize(
+                        'leave_payment_hours', payment_hours[line_id])
+            if shifts.get(line_id):
+                hours['worked_hours'] = quantize('worked_hours',
+                    shifts[line_id] * working_shift_hours)
+
+            difference = (hours['worked_hours'] - hours['hours_to_do']
+                - hours['generated_entitled_hours'])
+            hours['remaining_hours'] = Decimal(0)
+            hours['extra_hours'] = Decimal(0)
+            if working_hours and difference < Decimal(0):
+                hours['remaining_hours'] = -quantize('remaining_hours',
+                    difference)
+            elif difference > Decimal(0):
+                hours['extra_hours'] = quantize('extra_hours', difference)
+
+            for name in names:
+                result[name][line_id] = hours[name]
+        return result
 
     @property
     def hour_unit_price(self):
@@ -436,13 +805,55 @@ class PayslipLine(ModelSQL, ModelView):
                 / self.payslip.contract.working_shift_hours)
         return Decimal(0)
 
-    def get_amount(self, name):
-        if not self.working_shifts:
-            return Decimal(0)
-        amount = sum([s.cost for s in self.working_shifts])
-        amount += self.leave_hours * self.hour_unit_price
-        amount -= self.generated_entitled_hours * self.hour_unit_price
-        return amount.quantize(Decimal(str(10 ** -self.currency.digits)))
+    @classmethod
+    def get_amount(cls, lines, name):
+        pool = Pool()
+        WorkingShift = pool.get('working_shift')
+        working_shift = WorkingShift.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = [l.id for l in lines]
+        costs = defaultdict(Decimal)
+        to_compute = {}
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            cached = ((working_shift.state == 'done')
+                & (working_shift.cost_cache != Null))
+            cursor.execute(*working_shift.select(
+                    working_shift.payslip_line, Sum(working_shift.cost_cache),
+                    where=reduce_ids(working_shift.payslip_line, sub_ids)
+                    & cached,
+                    group_by=working_shift.payslip_line))
+            for line_id, cost in cursor:
+                if not isinstance(cost, Decimal):
+                    cost = Decimal(str(cost))
+                costs[line_id] += cost
+
+            cursor.execute(*working_shift.select(
+                    working_shift.id, working_shift.payslip_line,
+                    where=reduce_ids(working_shift.payslip_line, sub_ids)
+                    & ~cached))
+            to_compute.update(cursor)
+
+        shift_costs = WorkingShift._calc_costs(
+            WorkingShift.browse(list(to_compute)))
+        for shift_id, line_id in to_compute.items():
+            costs[line_id] += shift_costs[shift_id]
+
+        hours = cls.get_hours(lines,
+            ['leave_hours', 'generated_entitled_hours'])
+        amounts = {}
+        for line in lines:
+            if line.id not in costs:
+                amounts[line.id] = Decimal(0)
+                continue
+            amount = costs[line.id]
+            amount += hours['leave_hours'][line.id] * line.hour_unit_price
+            amount -= (hours['generated_entitled_hours'][line.id]
+                * line.hour_unit_price)
+            amounts[line.id] = amount.quantize(
+                Decimal(str(10 ** -line.currency.digits)))
+        return amounts
 
     def get_supplier_invoice_line(self):
         pool = Pool()
@@ -486,6 +897,39 @@ class PayslipLine(ModelSQL, ModelView):
         invoice_line.origin = self
         return invoice_line
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        lines = super(PayslipLine, cls).create(vlist)
+        SummaryCache.refresh(SummaryCache._get_payslip_keys(
+                {l.payslip.id for l in lines}))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        # Only the fields used to compute the hours require a refresh
+        lines = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if values.keys() & {'payslip', 'working_hours'}:
+                lines.extend(records)
+        payslip_ids = {l.payslip.id for l in lines}
+        super(PayslipLine, cls).write(*args)
+        if lines:
+            payslip_ids |= {l.payslip.id for l in lines}
+            SummaryCache.refresh(SummaryCache._get_payslip_keys(payslip_ids))
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        keys = SummaryCache._get_payslip_keys({l.payslip.id for l in lines})
+        super(PayslipLine, cls).delete(lines)
+        SummaryCache.refresh(keys)
+
     @classmethod
     def validate(cls, lines):
         super(PayslipLine, cls).validate(lines)
@@ -517,6 +961,110 @@ class PayslipLine(ModelSQL, ModelView):
         return super(PayslipLine, cls).copy(lines, default=default)
 
 
+class GeneratePayslipsStart(ModelView):
+    'Generate Payslips Start'
+    __name__ = 'payroll.payslip.generate.start'
+    start = fields.Date('Start', required=True)
+    end = fields.Date('End', required=True, domain=[
+            ('end', '>=', Eval('start')),
+            ])
+    employees = fields.Many2Many('company.employee', None, None, 'Employees',
+        help="Leave empty to generate the payslips of all the employees with "
+        "a confirmed contract.")
+    line_type = fields.Many2One('payroll.payslip.line.type', 'Line Type',
+        required=True)
+    working_hours = fields.Numeric('Working Hours', digits=(16, 2),
+        required=True, domain=[
+            ('working_hours', '>=', Decimal(0)),
+            ],
+        help='Number of working hours in the period. Usually 8 * 20.')
+
+
+class GeneratePayslips(Wizard):
+    'Generate Payslips'
+    __name__ = 'payroll.payslip.generate'
+    start = StateView('payroll.payslip.generate.start',
+        'payroll.payslip_generate_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Generate', 'generate', 'tryton-ok', default=True),
+            ])
+    generate = StateAction('payroll.act_payslip')
+
+    def do_generate(self, action):
+        pool = Pool()
+        Payslip = pool.get('payroll.payslip')
+        payslips = Payslip.generate_payslips(self.start.start, self.start.end,
+            self.start.line_type, self.start.working_hours,
+            employees=self.start.employees or None)
+        action['pyson_domain'] = PYSONEncoder().encode([
+                ('id', 'in', [p.id for p in payslips]),
+                ])
+        return action, {}
+
+
+class LeavePeriod(metaclass=PoolMeta):
+    __name__ = 'employee.leave.period'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        actions = iter(args)
+        period_ids = set()
+        for periods, values in zip(actions, actions):
+            if values.keys() & {'start', 'end'}:
+                period_ids.update(p.id for p in periods)
+        super(LeavePeriod, cls).write(*args)
+        if period_ids:
+            # The contracts of the periods may have changed with the dates
+            period_ids = list(period_ids)
+            SummaryCache.delete(SummaryCache.search([
+                        ('leave_period', 'in', period_ids),
+                        ]))
+            SummaryCache.refresh(SummaryCache._get_period_keys(period_ids))
+
+    @classmethod
+    def delete(cls, periods):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        SummaryCache.delete(SummaryCache.search([
+                    ('leave_period', 'in', [p.id for p in periods]),
+                    ]))
+        super(LeavePeriod, cls).delete(periods)
+
+
+class Leave(metaclass=PoolMeta):
+    __name__ = 'employee.leave'
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        leaves = super(Leave, cls).create(vlist)
+        SummaryCache.refresh(SummaryCache._get_employee_keys(
+                {(l.employee.id, l.start, l.end) for l in leaves}))
+        return leaves
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        leaves = sum(args[::2], [])
+        ranges = {(l.employee.id, l.start, l.end) for l in leaves}
+        super(Leave, cls).write(*args)
+        ranges |= {(l.employee.id, l.start, l.end) for l in leaves}
+        SummaryCache.refresh(SummaryCache._get_employee_keys(ranges))
+
+    @classmethod
+    def delete(cls, leaves):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        keys = SummaryCache._get_employee_keys(
+            {(l.employee.id, l.start, l.end) for l in leaves})
+        super(Leave, cls).delete(leaves)
+        SummaryCache.refresh(keys)
+
+
 class Entitlement(metaclass=PoolMeta):
     __name__ = 'employee.leave.entitlement'
     payslip_line = fields.Many2One('payroll.payslip.line', 'Payslip Line',
@@ -524,6 +1072,13 @@ class Entitlement(metaclass=PoolMeta):
     payslip = fields.Function(fields.Many2One('payroll.payslip', 'Payslip'),
         'get_payslip', searcher='search_payslip')
 
+    @classmethod
+    def __setup__(cls):
+        super(Entitlement, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.payslip_line, Index.Equality())))
+
     def get_payslip(self, name):
         return self.payslip_line.payslip.id if self.payslip_line else None
 
@@ -533,6 +1088,34 @@ class Entitlement(metaclass=PoolMeta):
             ('payslip_line.payslip',) + tuple(clause[1:]),
             ]
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        records = super(Entitlement, cls).create(vlist)
+        SummaryCache.refresh(SummaryCache._get_line_record_keys(
+                cls, [r.id for r in records]))
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        ids = [r.id for r in sum(args[::2], [])]
+        keys = SummaryCache._get_line_record_keys(cls, ids)
+        super(Entitlement, cls).write(*args)
+        SummaryCache.refresh(
+            keys | SummaryCache._get_line_record_keys(cls, ids))
+
+    @classmethod
+    def delete(cls, entitlements):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        keys = SummaryCache._get_line_record_keys(
+            cls, [r.id for r in entitlements])
+        super(Entitlement, cls).delete(entitlements)
+        SummaryCache.refresh(keys)
+
     @classmethod
     def copy(cls, entitlements, default=None):
         if default is None:
@@ -549,6 +1132,13 @@ class LeavePayment(metaclass=PoolMeta):
     payslip = fields.Function(fields.Many2One('payroll.payslip', 'Payslip'),
         'get_payslip', searcher='search_payslip')
 
+    @classmethod
+    def __setup__(cls):
+        super(LeavePayment, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.payslip_line, Index.Equality())))
+
     def get_payslip(self, name):
         return self.payslip_line.payslip.id if self.payslip_line else None
 
@@ -558,6 +1148,34 @@ class LeavePayment(metaclass=PoolMeta):
             ('payslip_line.payslip',) + tuple(clause[1:]),
             ]
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        records = super(LeavePayment, cls).create(vlist)
+        SummaryCache.refresh(SummaryCache._get_line_record_keys(
+                cls, [r.id for r in records]))
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        ids = [r.id for r in sum(args[::2], [])]
+        keys = SummaryCache._get_line_record_keys(cls, ids)
+        super(LeavePayment, cls).write(*args)
+        SummaryCache.refresh(
+            keys | SummaryCache._get_line_record_keys(cls, ids))
+
+    @classmethod
+    def delete(cls, leave_payments):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        keys = SummaryCache._get_line_record_keys(
+            cls, [r.id for r in leave_payments])
+        super(LeavePayment, cls).delete(leave_payments)
+        SummaryCache.refresh(keys)
+
     @classmethod
     def copy(cls, leave_payments, default=None):
         if default is None:
@@ -567,8 +1185,9 @@ class LeavePayment(metaclass=PoolMeta):
         return super(LeavePayment, cls).copy(leave_payments, default=default)
 
 
-class WorkingShift(metaclass=PoolMeta):
+class WorkingShift(InstrumentationMixin, metaclass=PoolMeta):
     __name__ = 'working_shift'
+    _instrumented_methods = ('set_cache_values',)
     payslip_line = fields.Many2One('payroll.payslip.line', 'Payslip Line',
         readonly=True)
     payslip = fields.Function(fields.Many2One('payroll.payslip', 'Payslip'),
@@ -584,13 +1203,59 @@ class WorkingShift(metaclass=PoolMeta):
     cache_timestamp = fields.DateTime('Cache Timestamp', readonly=True)
 
     @classmethod
-    def __register__(cls, module_name):
-        table = backend.TableHandler(cls, module_name)
-        created_cost_cache = not table.column_exist('cost_cache')
-        super(WorkingShift, cls).__register__(module_name)
-        table = backend.TableHandler(cls, module_name)
-        if created_cost_cache and table.column_exist('cost_cache'):
-            cls.set_cache_values(cls.search([]))
+    def __setup__(cls):
+        super(WorkingShift, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.payslip_line, Index.Equality())))
+
+    @classmethod
+    def backfill_cost_cache(cls, chunk_size=None, commit=True):
+        """
+        Set the cache values of the done working shifts in a payslip never
+        processed, walking them by id in chunks of chunk_size.
+        The processed working shifts get a cache timestamp even when no rule
+        matches so they are not processed again.
+        If commit is set, each chunk is committed so an interrupted backfill
+        resumes with the remaining working shifts. It must not be set inside
+        a module update.
+        Return the number of processed working shifts.
+        """
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if chunk_size is None:
+            chunk_size = config.getint(
+                'payroll', 'cost_cache_backfill_chunk', default=1000)
+        started = monotonic()
+        last_id = count = 0
+        while True:
+            cursor.execute(*table.select(table.id,
+                    where=(table.id > last_id)
+                    & (table.state == 'done')
+                    & (table.payslip_line != Null)
+                    & (table.cache_timestamp == Null),
+                    order_by=[table.id.asc],
+                    limit=chunk_size))
+            ids = [i for i, in cursor]
+            if not ids:
+                break
+            cls.set_cache_values(cls.browse(ids))
+            cursor.execute(*table.update(
+                    [table.cache_timestamp], [datetime.now()],
+                    where=reduce_ids(table.id, ids)
+                    & (table.cache_timestamp == Null)))
+            clear_records_cache(cls, ids)
+            if commit:
+                transaction.commit()
+            last_id = ids[-1]
+            count += len(ids)
+            elapsed = monotonic() - started
+            logger.info("Cost cache backfill: %s working shifts "
+                "in %.1fs (%.1f/s)", count, elapsed,
+                count / elapsed if elapsed else count)
+        return count
 
     def get_payslip(self, name):
         return self.payslip_line.payslip.id if self.payslip_line else None
@@ -614,10 +1279,35 @@ class WorkingShift(metaclass=PoolMeta):
     def compute_interventions(self):
         return len(self.interventions) > 0
 
-    def get_cost(self, name):
-        if self.cost_cache and self.state == 'done':
-            return self.cost_cache
-        return self._calc_cost()
+    @classmethod
+    def get_cost(cls, working_shifts, name):
+        costs = {}
+        to_compute = []
+        for ws in working_shifts:
+            if ws.cost_cache and ws.state == 'done':
+                costs[ws.id] = ws.cost_cache
+            else:
+                to_compute.append(ws)
+        costs.update(cls._calc_costs(to_compute))
+        return costs
+
+    @classmethod
+    def _calc_costs(cls, working_shifts):
+        """
+        Return a dictionary with the cost of each working shift id, resolving
+        the contracts and rules of all the working shifts at once
+        """
+        contract_rules = cls._calc_employees_contract_rules(working_shifts)
+        costs = {}
+        for ws in working_shifts:
+            ws_rule, int_rules = contract_rules[ws.id]
+            if ws_rule or int_rules:
+                costs[ws.id] = ws._calc_cost(
+                    working_shift_rule=ws_rule,
+                    interventions_rules=int_rules)
+            else:
+                costs[ws.id] = ws.employee.company.currency.round(Decimal(0))
+        return costs
 
     def _calc_employee_constract_rules(self):
         """
@@ -628,6 +1318,13 @@ class WorkingShift(metaclass=PoolMeta):
         if self.payslip_line:
             employee_contract = self.employee.get_payroll_contract(
                 self.payslip.start, self.payslip.end)
+        return self._calc_contract_rules(employee_contract)
+
+    def _calc_contract_rules(self, employee_contract):
+        """
+        Return the tuple of _calc_employee_constract_rules for the supplied
+        employee contract
+        """
         if not employee_contract:
             return None, None
 
@@ -644,6 +1341,25 @@ class WorkingShift(metaclass=PoolMeta):
         rule = employee_contract.compute_working_shift_matching_rule(self)
         return rule, None
 
+    @classmethod
+    def _calc_employees_contract_rules(cls, working_shifts):
+        """
+        Return a dictionary with the tuple of _calc_employee_constract_rules
+        of each working shift id. The contract is resolved once for each
+        employee and payslip period.
+        """
+        pool = Pool()
+        Employee = pool.get('company.employee')
+
+        keys = {}
+        for ws in working_shifts:
+            if ws.payslip_line:
+                payslip = ws.payslip_line.payslip
+                keys[ws.id] = (ws.employee.id, payslip.start, payslip.end)
+        contracts = Employee.get_payroll_contracts(set(keys.values()))
+        return {ws.id: ws._calc_contract_rules(contracts.get(keys.get(ws.id)))
+            for ws in working_shifts}
+
     def _calc_cost(self, working_shift_rule=None, interventions_rules=None):
         currency = self.employee.company.currency
 
@@ -664,7 +1380,7 @@ class WorkingShift(metaclass=PoolMeta):
     @Workflow.transition('done')
     def done(cls, working_shifts):
         super(WorkingShift, cls).done(working_shifts)
-        cls.set_cache_values(working_shifts)
+        # The cache values are set by write once the state is done
 
     @classmethod
     @ModelView.button
@@ -673,48 +1389,195 @@ class WorkingShift(metaclass=PoolMeta):
         super(WorkingShift, cls).cancel(working_shifts)
         cls.clear_cache_values(working_shifts)
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        # The state is written by the transitions after done and cancel
+        refresh = any({'state', 'payslip_line'} & values.keys()
+            for values in args[1::2])
+        if refresh:
+            working_shifts = sum(args[::2], [])
+            payslip_ids = cls._get_payslip_ids(working_shifts)
+        to_cache = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if values.get('state') == 'done':
+                to_cache.extend(ws.id for ws in records if ws.state != 'done')
+        super(WorkingShift, cls).write(*args)
+        if to_cache:
+            cls.set_cache_values(cls.browse(to_cache))
+        if refresh:
+            payslip_ids |= cls._get_payslip_ids(working_shifts)
+            SummaryCache.refresh(SummaryCache._get_payslip_keys(payslip_ids))
+
+    @staticmethod
+    def _get_payslip_ids(working_shifts):
+        return {ws.payslip_line.payslip.id for ws in working_shifts
+            if ws.payslip_line}
+
     @classmethod
     def set_cache_values(cls, working_shifts):
-        to_write = []
+        pool = Pool()
+        Intervention = pool.get('working_shift.intervention')
+        table = cls.__table__()
+        intervention = Intervention.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        working_shifts = [ws for ws in working_shifts if ws.state == 'done']
+        contract_rules = cls._calc_employees_contract_rules(working_shifts)
+
+        # Group the values to write them with as few updates as possible
+        to_update = defaultdict(list)
+        interventions_to_update = defaultdict(list)
         for ws in working_shifts:
-            if ws.state != 'done':
+            ws_rule, int_rules = contract_rules[ws.id]
+            # Without rule there is no cache value to set
+            if not ws_rule and not int_rules:
                 continue
-            ws_rule, int_rules = ws._calc_employee_constract_rules()
             cost = ws._calc_cost(
                 working_shift_rule=ws_rule,
                 interventions_rules=int_rules)
             if int_rules:
-                to_write.extend(([ws], {
-                            'interventions': [
-                                ('write', [i], {'employee_contract_rule': r})
-                                for (i, r) in int_rules.items()],
-                            'cost_cache': cost,
-                            'cache_timestamp': datetime.now(),
-                            }))
-            elif ws_rule:
-                to_write.extend(([ws], {
-                            'employee_contract_rule': ws_rule,
-                            'cost_cache': cost,
-                            'cache_timestamp': datetime.now(),
-                            }))
-        if to_write:
-            cls.write(*to_write)
+                to_update[(None, cost)].append(ws.id)
+                for intervention_, rule in int_rules.items():
+                    interventions_to_update[(rule.id, rule.cost_price)].append(
+                        intervention_.id)
+            else:
+                to_update[(ws_rule.id, cost)].append(ws.id)
+
+        now = datetime.now()
+        for (rule_id, cost), ids in to_update.items():
+            columns = [table.cost_cache, table.cache_timestamp,
+                table.write_uid, table.write_date]
+            values = [cost, now, transaction.user, CurrentTimestamp()]
+            if rule_id:
+                columns.append(table.employee_contract_rule)
+                values.append(rule_id)
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(columns, values,
+                        where=reduce_ids(table.id, sub_ids)))
+        for (rule_id, cost), ids in interventions_to_update.items():
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*intervention.update(
+                        [intervention.employee_contract_rule,
+                            intervention.cost_cache,
+                            intervention.write_uid, intervention.write_date],
+                        [rule_id, cost, transaction.user,
+                            CurrentTimestamp()],
+                        where=reduce_ids(intervention.id, sub_ids)))
+        clear_records_cache(cls,
+            [i for ids in to_update.values() for i in ids])
+        clear_records_cache(Intervention,
+            [i for ids in interventions_to_update.values() for i in ids])
 
     @classmethod
     def clear_cache_values(cls, working_shifts):
         pool = Pool()
         Intervention = pool.get('working_shift.intervention')
-        cls.write(working_shifts, {
-                'employee_contract_rule': None,
-                'cost_cache': None,
-                'cache_timestamp': None,
-                })
-        interventions = [i for ws in working_shifts for i in ws.interventions
-            if i.employee_contract_rule]
-        if interventions:
-            Intervention.write(interventions, {
-                    'employee_contract_rule': None,
-                    })
+        table = cls.__table__()
+        intervention = Intervention.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        ids = [ws.id for ws in working_shifts]
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.update(
+                    [table.employee_contract_rule, table.cost_cache,
+                        table.cache_timestamp, table.write_uid,
+                        table.write_date],
+                    [None, None, None, transaction.user, CurrentTimestamp()],
+                    where=reduce_ids(table.id, sub_ids)))
+            cursor.execute(*intervention.update(
+                    [intervention.employee_contract_rule,
+                        intervention.cost_cache,
+                        intervention.write_uid, intervention.write_date],
+                    [None, None, transaction.user, CurrentTimestamp()],
+                    where=reduce_ids(intervention.shift, sub_ids)
+                    & (intervention.employee_contract_rule != Null)))
+        clear_records_cache(cls, ids)
+        # The updated interventions are not known without querying them
+        clear_records_cache(Intervention)
+
+    @classmethod
+    def _get_cache_ids(cls, rule_ids=None, ranges=None):
+        """
+        Return the ids of the done working shifts of not invoiced payslips
+        whose cache values use the rule ids or whose payslip is in one of the
+        (employee id, start, end) ranges, where end may be None
+        """
+        pool = Pool()
+        Intervention = pool.get('working_shift.intervention')
+        PayslipLine = pool.get('payroll.payslip.line')
+        Payslip = pool.get('payroll.payslip')
+        table = cls.__table__()
+        intervention = Intervention.__table__()
+        line = PayslipLine.__table__()
+        payslip = Payslip.__table__()
+        cursor = Transaction().connection.cursor()
+
+        query = table.join(line,
+            condition=table.payslip_line == line.id
+            ).join(payslip,
+            condition=line.payslip == payslip.id)
+        where = ((table.state == 'done')
+            & (payslip.supplier_invoice == Null))
+
+        ids = set()
+        for sub_ids in grouped_slice(list(rule_ids or [])):
+            sub_ids = list(sub_ids)
+            cursor.execute(*query.select(table.id,
+                    where=where
+                    & (reduce_ids(table.employee_contract_rule, sub_ids)
+                        | table.id.in_(intervention.select(
+                                intervention.shift,
+                                where=reduce_ids(
+                                    intervention.employee_contract_rule,
+                                    sub_ids))))))
+            ids.update(i for i, in cursor)
+        for sub_ranges in grouped_slice(list(ranges or [])):
+            range_where = Literal(False)
+            for employee_id, start, end in sub_ranges:
+                range_condition = ((payslip.employee == employee_id)
+                    & (payslip.end >= start))
+                if end:
+                    range_condition &= payslip.start <= end
+                range_where |= range_condition
+            cursor.execute(*query.select(table.id,
+                    where=where & range_where))
+            ids.update(i for i, in cursor)
+        return ids
+
+    @classmethod
+    def update_cache_values(cls, ids):
+        """
+        Compute again the cache values of the working shift ids and return
+        the number of working shifts whose cost changed
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def get_costs():
+            costs = {}
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.select(table.id, table.cost_cache,
+                        where=reduce_ids(table.id, sub_ids)))
+                costs.update(cursor)
+            return costs
+
+        ids = list(ids)
+        if not ids:
+            return 0
+        old_costs = get_costs()
+        cls.clear_cache_values(cls.browse(ids))
+        cls.set_cache_values(cls.browse(ids))
+        new_costs = get_costs()
+        changed = sum(1 for i in ids if old_costs.get(i) != new_costs.get(i))
+        logger.info("Cost cache updated for %s working shifts, "
+            "%s changed", len(ids), changed)
+        return changed
 
     @classmethod
     def copy(cls, working_shifts, default=None):
@@ -732,6 +1595,46 @@ class Intervention(metaclass=PoolMeta):
     __name__ = 'working_shift.intervention'
     employee_contract_rule = fields.Many2One('payroll.contract.rule',
         'Employee Contract Rule', readonly=True)
+    cost_cache = fields.Numeric('Cost Cache', digits=price_digits,
+        readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Rule = pool.get('payroll.contract.rule')
+        WorkingShift = pool.get('working_shift')
+        table = backend.TableHandler(cls, module_name)
+        sql_table = cls.__table__()
+        rule = Rule.__table__()
+        cursor = Transaction().connection.cursor()
+        created_cost_cache = not table.column_exist('cost_cache')
+
+        super(Intervention, cls).__register__(module_name)
+
+        # Fill the cost cache with the price of the stored rule
+        if created_cost_cache:
+            cursor.execute(*sql_table.update(
+                    [sql_table.cost_cache],
+                    [rule.select(rule.cost_price, where=(
+                                rule.id == sql_table.employee_contract_rule))],
+                    where=sql_table.employee_contract_rule != Null))
+
+        # Fill the cost cache of the working shifts left without it by a
+        # previous update once the columns of both tables exist. The backfill
+        # can be deferred to the cron task on big databases to not block the
+        # update.
+        if not config.getboolean(
+                'payroll', 'defer_cost_cache_backfill', default=False):
+            WorkingShift.backfill_cost_cache(commit=False)
+
+    @classmethod
+    def copy(cls, interventions, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default['employee_contract_rule'] = None
+        default['cost_cache'] = None
+        return super(Intervention, cls).copy(interventions, default=default)
 
 
 class InvoiceLine(metaclass=PoolMeta):
@@ -0,0 +1,129 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Benchmark the payroll hot paths with synthetic data:
+
+    python -m trytond.modules.payroll.tests.benchmark --employees 100
+
+The database is the one of the tests, so it runs against SQLite or
+PostgreSQL depending on TRYTOND_DATABASE_URI and DB_NAME.
+For each scenario the wall time, the number of SQL statements and the peak
+of memory allocated are reported.
+"""
+import argparse
+import datetime
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.payroll.instrumentation import count_queries
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, USER, activate_module
+from trytond.transaction import Transaction
+
+from .tools import (
+    clear_transaction_cache, create_payroll_data, read_function_fields,
+    setup_payroll)
+
+
+class Report(object):
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.out.write('%-40s %10s %10s %12s\n'
+            % ("Scenario", "Time (s)", "Queries", "Memory (KiB)"))
+
+    @contextmanager
+    def measure(self, name):
+        clear_transaction_cache()
+        tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            with count_queries() as counter:
+                yield
+        finally:
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        self.out.write('%-40s %10.3f %10d %12d\n'
+            % (name, elapsed, counter.count, peak // 1024))
+
+
+def run(options):
+    pool = Pool()
+    WorkingShift = pool.get('working_shift')
+    Payslip = pool.get('payroll.payslip')
+    PayslipLine = pool.get('payroll.payslip.line')
+    Summary = pool.get('payroll.contract.hours_summary')
+
+    year = datetime.date.today().year
+    start, end = datetime.date(year, 1, 1), datetime.date(year, 1, 31)
+    report = Report()
+
+    company = create_company()
+    with set_company(company):
+        line_type = setup_payroll(company)
+        with report.measure("generate data"):
+            data = create_payroll_data(company, line_type, year,
+                employees=options.employees,
+                contracts=options.contracts,
+                rulesets=options.rulesets,
+                rules=options.rules,
+                shifts=options.shifts,
+                interventions=options.interventions,
+                leaves=options.leaves,
+                entitlements=options.entitlements,
+                payments=options.payments)
+        shift_ids = [s.id for s in data['working_shift']]
+
+        with report.measure("WorkingShift.done"):
+            WorkingShift.done(WorkingShift.browse(shift_ids))
+        with report.measure("Payslip.generate_payslips"):
+            payslips = Payslip.generate_payslips(
+                start, end, line_type, Decimal(160))
+        with report.measure("WorkingShift.set_cache_values"):
+            WorkingShift.set_cache_values(WorkingShift.browse(shift_ids))
+        with report.measure("read payroll.payslip"):
+            read_function_fields(Payslip, payslips)
+        with report.measure("read payroll.payslip.line"):
+            read_function_fields(PayslipLine,
+                [l for p in payslips for l in p.lines])
+        with report.measure("Payslip.create_supplier_invoices"):
+            Payslip.create_supplier_invoices(
+                Payslip.browse([p.id for p in payslips]))
+        summaries = Summary.search([])
+        with report.measure("read payroll.contract.hours_summary"):
+            read_function_fields(Summary, summaries)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the payroll hot paths")
+    for name, default in [
+            ('employees', 10),
+            ('contracts', 1),
+            ('rulesets', 2),
+            ('rules', 4),
+            ('shifts', 20),
+            ('interventions', 2),
+            ('leaves', 1),
+            ('entitlements', 1),
+            ('payments', 1),
+            ]:
+        parser.add_argument('--%s' % name, type=int, default=default,
+            help="number of %s (per employee or ruleset)" % name)
+    options = parser.parse_args(args)
+
+    activate_module('payroll')
+    with Transaction().start(DB_NAME, USER, context={}) as transaction:
+        try:
+            run(options)
+        finally:
+            transaction.rollback()
+
+
+if __name__ == '__main__':
+    main()
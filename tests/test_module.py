@@ -1,14 +1,456 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime
+from decimal import Decimal
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.model.exceptions import ValidationError
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, create_employee, set_company)
+from trytond.modules.payroll.instrumentation import count_queries
+from trytond.modules.payroll.tests.tools import (
+    clear_transaction_cache, create_payroll_data, create_payslip,
+    read_function_fields, setup_payroll)
+from trytond.pool import Pool
+from trytond.pyson import PYSONDecoder
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 
 
 class PayrollTestCase(CompanyTestMixin, ModuleTestCase):
     'Test Payroll module'
     module = 'payroll'
 
+    @with_transaction()
+    def test_read_queries(self):
+        "Test reading function fields does not run queries by record"
+        pool = Pool()
+        Payslip = pool.get('payroll.payslip')
+        PayslipLine = pool.get('payroll.payslip.line')
+        PayslipLineType = pool.get('payroll.payslip.line.type')
+        Summary = pool.get('payroll.contract.hours_summary')
+        WorkingShift = pool.get('working_shift')
+
+        year = datetime.date.today().year
+        company = create_company()
+        with set_company(company):
+            line_type = setup_payroll(company)
+            data = create_payroll_data(company, line_type, year,
+                employees=4, shifts=5)
+            shifts = data['working_shift']
+            WorkingShift.done(shifts)
+            payslips = Payslip.generate_payslips(datetime.date(year, 1, 1),
+                datetime.date(year, 1, 31), line_type, Decimal(160))
+            payslips = sorted(payslips, key=lambda p: p.employee.id)
+
+            # The first payslip has 1 line with 1 working shift and the
+            # others 3 lines with 3, 1 and 1 working shifts
+            line_types = PayslipLineType.create([{
+                        'name': "Extra %s" % i,
+                        'product': line_type.product.id,
+                        } for i in range(2)])
+            first, = payslips[0].lines
+            WorkingShift.write(list(first.working_shifts[1:]), {
+                    'payslip_line': None,
+                    })
+            for payslip in payslips[1:]:
+                line, = payslip.lines
+                extra_lines = PayslipLine.create([{
+                            'payslip': payslip.id,
+                            'type': t.id,
+                            'working_hours': Decimal(0),
+                            } for t in line_types])
+                working_shifts = list(line.working_shifts)
+                for extra_line, working_shift in zip(
+                        extra_lines, working_shifts[3:]):
+                    WorkingShift.write([working_shift], {
+                            'payslip_line': extra_line.id,
+                            })
+            payslips = Payslip.browse([p.id for p in payslips])
+
+            def count(Model, records):
+                clear_transaction_cache()
+                with count_queries() as counter:
+                    read_function_fields(Model, records)
+                return counter.count
+
+            def summaries(payslips):
+                return Summary.search([
+                        ('contract', 'in',
+                            [p.contract.id for p in payslips]),
+                        ])
+
+            # Fill the caches that do not depend on the records
+            read_function_fields(Payslip, payslips)
+            read_function_fields(PayslipLine,
+                [l for p in payslips for l in p.lines])
+            read_function_fields(Summary, summaries(payslips))
+
+            self.assertEqual(
+                count(Payslip, payslips[1:]),
+                count(Payslip, payslips[:1]))
+            self.assertEqual(
+                count(PayslipLine, [l for p in payslips[1:] for l in p.lines]),
+                count(PayslipLine, payslips[0].lines))
+            self.assertEqual(
+                count(Summary, summaries(payslips[1:])),
+                count(Summary, summaries(payslips[:1])))
+
+    @with_transaction()
+    def test_working_shift_done_cost_cache(self):
+        "Test marking working shifts as done sets their cache values"
+        pool = Pool()
+        WorkingShift = pool.get('working_shift')
+
+        year = datetime.date.today().year
+        company = create_company()
+        with set_company(company):
+            line_type = setup_payroll(company)
+            data = create_payroll_data(company, line_type, year,
+                employees=1, rulesets=1, shifts=2, interventions=0)
+            contract, = data['payroll.contract']
+            ruleset, = data['payroll.contract.ruleset']
+            shifts = data['working_shift']
+            create_payslip(contract, line_type, datetime.date(year, 1, 1),
+                datetime.date(year, 1, 31), shifts)
+
+            WorkingShift.done(WorkingShift.browse([s.id for s in shifts]))
+
+            # Both working shifts last at most 2 hours so they match the
+            # first rule
+            rule = ruleset.rules[0]
+            for shift in WorkingShift.browse([s.id for s in shifts]):
+                self.assertEqual(shift.state, 'done')
+                self.assertEqual(shift.cost_cache, Decimal('100.00'))
+                self.assertEqual(shift.employee_contract_rule, rule)
+                self.assertIsNotNone(shift.cache_timestamp)
+
+    @with_transaction()
+    def test_generate_payslips(self):
+        "Test generating payslips"
+        pool = Pool()
+        Payslip = pool.get('payroll.payslip')
+        WorkingShift = pool.get('working_shift')
+        GeneratePayslips = pool.get('payroll.payslip.generate', type='wizard')
+
+        year = datetime.date.today().year
+        start, end = datetime.date(year, 1, 1), datetime.date(year, 1, 31)
+        company = create_company()
+        with set_company(company):
+            line_type = setup_payroll(company)
+            data = create_payroll_data(company, line_type, year,
+                employees=3, rulesets=1, shifts=3, interventions=0)
+            employee1, employee2, employee3 = data['company.employee']
+            contract1, contract2, contract3 = data['payroll.contract']
+            shifts = {e: [s for s in data['working_shift'] if s.employee == e]
+                for e in data['company.employee']}
+            WorkingShift.done(shifts[employee1] + shifts[employee2][:2]
+                + shifts[employee3])
+
+            # The first employee already has a payslip and a working shift
+            # of the second one is in a payslip of another period
+            existing = create_payslip(contract1, line_type, start, end)
+            other = create_payslip(contract2, line_type,
+                datetime.date(year, 2, 1), datetime.date(year, 2, 28),
+                shifts[employee2][:1])
+
+            session_id, _, _ = GeneratePayslips.create()
+            generate = GeneratePayslips(session_id)
+            generate.start.start = start
+            generate.start.end = end
+            generate.start.employees = []
+            generate.start.line_type = line_type
+            generate.start.working_hours = Decimal(160)
+            action, _ = generate.do_generate({})
+
+            payslips = Payslip.search(
+                PYSONDecoder().decode(action['pyson_domain']),
+                order=[('employee', 'ASC')])
+            self.assertEqual(
+                [p.employee for p in payslips], [employee2, employee3])
+            self.assertEqual(
+                Payslip.search([('employee', '=', employee1.id)]),
+                [existing])
+            payslip2, payslip3 = payslips
+
+            line2, = payslip2.lines
+            self.assertEqual(
+                list(line2.working_shifts), shifts[employee2][1:2])
+            self.assertEqual(
+                [s.payslip for s in WorkingShift.browse(shifts[employee2])],
+                [other, payslip2, None])
+            line3, = payslip3.lines
+            self.assertEqual(
+                sorted(line3.working_shifts), sorted(shifts[employee3]))
+            for line in [line2, line3]:
+                self.assertEqual(len(line.generated_entitlements), 1)
+                self.assertEqual(len(line.leave_payments), 1)
+                for shift in line.working_shifts:
+                    self.assertIsNotNone(shift.cost_cache)
+            self.assertFalse(existing.lines[0].working_shifts)
+            self.assertFalse(existing.lines[0].generated_entitlements)
+
+    @with_transaction()
+    def test_contract_overlap(self):
+        "Test confirming overlapping contracts"
+        pool = Pool()
+        Contract = pool.get('payroll.contract')
+
+        year = datetime.date.today().year
+        company = create_company()
+        with set_company(company):
+            line_type = setup_payroll(company)
+            data = create_payroll_data(company, line_type, year,
+                employees=1, rulesets=1, shifts=0, interventions=0)
+            employee, = data['company.employee']
+            ruleset, = data['payroll.contract.ruleset']
+            other = create_employee(company, name="Other")
+
+            def create(employee, start, end):
+                contract, = Contract.create([{
+                            'employee': employee.id,
+                            'start': start,
+                            'end': end,
+                            'yearly_hours': Decimal(1840),
+                            'working_shift_hours': Decimal(8),
+                            'working_shift_price': Decimal(360),
+                            'ruleset': ruleset.id,
+                            }])
+                return contract
+
+            # Contracts following each other do not overlap
+            Contract.confirm([
+                    create(employee, datetime.date(year + 1, 1, 1), None),
+                    ])
+            Contract.confirm([
+                    create(other, datetime.date(year, 1, 1),
+                        datetime.date(year, 6, 30)),
+                    create(other, datetime.date(year, 7, 1), None),
+                    ])
+
+            # Overlap with an existing confirmed contract
+            contract = create(employee, datetime.date(year, 6, 1),
+                datetime.date(year, 6, 30))
+            with self.assertRaises(ValidationError):
+                Contract.confirm([contract])
+
+            # Overlap inside the same batch
+            another = create_employee(company, name="Another")
+            contracts = [
+                create(another, datetime.date(year, 1, 1),
+                    datetime.date(year, 6, 30)),
+                create(another, datetime.date(year, 6, 30), None),
+                ]
+            with self.assertRaises(ValidationError):
+                Contract.confirm(contracts)
+
+    @with_transaction()
+    def test_hours_summary_cache_refresh(self):
+        "Test the stored hours summaries are refreshed by the changes"
+        pool = Pool()
+        Payslip = pool.get('payroll.payslip')
+        SummaryCache = pool.get('payroll.contract.hours_summary.cache')
+        WorkingShift = pool.get('working_shift')
+        Entitlement = pool.get('employee.leave.entitlement')
+        Leave = pool.get('employee.leave')
+        LeavePeriod = pool.get('employee.leave.period')
+
+        year = datetime.date.today().year
+        company = create_company()
+        with set_company(company):
+            line_type = setup_payroll(company)
+            data = create_payroll_data(company, line_type, year,
+                employees=1, rulesets=1, shifts=2, interventions=0)
+            contract, = data['payroll.contract']
+            period, = data['employee.leave.period']
+            leave, = data['employee.leave']
+            entitlement, = data['employee.leave.entitlement']
+            shifts = data['working_shift']
+            WorkingShift.done(shifts)
+            Payslip.generate_payslips(datetime.date(year, 1, 1),
+                datetime.date(year, 1, 31), line_type, Decimal(160))
+            SummaryCache.rebuild()
+
+            def stored():
+                clear_transaction_cache()
+                cache, = SummaryCache.search([
+                        ('contract', '=', contract.id),
+                        ('leave_period', '=', period.id),
+                        ])
+                return {n: getattr(cache, n)
+                    for n in SummaryCache._hours_names()}
+
+            hours = stored()
+            self.assertEqual(hours['worked_hours'], Decimal('16.00'))
+            self.assertEqual(hours['entitled_hours'], Decimal('4.00'))
+
+            # Working shift removed from its payslip
+            WorkingShift.write(
+                WorkingShift.browse([shifts[0].id]), {'payslip_line': None})
+            self.assertEqual(stored()['worked_hours'], Decimal('8.00'))
+
+            # Entitlement hours changed
+            Entitlement.write(
+                Entitlement.browse([entitlement.id]), {'hours': Decimal(2)})
+            self.assertEqual(stored()['entitled_hours'], Decimal('2.00'))
+
+            # New done leave
+            hours = stored()
+            day = datetime.date(year, 1, 20)
+            new_leave, = Leave.create([{
+                        'employee': leave.employee.id,
+                        'period': period.id,
+                        'type': leave.type.id,
+                        'request_date': day,
+                        'hours': Decimal(8),
+                        'start': day,
+                        'end': day,
+                        }])
+            Leave.approve([new_leave])
+            Leave.done([new_leave])
+            self.assertGreater(stored()['leave_hours'], hours['leave_hours'])
+
+            # Period no longer containing the payslip
+            LeavePeriod.write([period], {
+                    'start': datetime.date(year, 2, 1),
+                    })
+            hours = stored()
+            self.assertEqual(hours['working_hours'], Decimal('0.00'))
+            self.assertEqual(hours['worked_hours'], Decimal('0.00'))
+
+    @with_transaction()
+    def test_rule_change_cost_cache(self):
+        "Test changing contract rules updates the cost cache"
+        pool = Pool()
+        Payslip = pool.get('payroll.payslip')
+        Rule = pool.get('payroll.contract.rule')
+        WorkingShift = pool.get('working_shift')
+
+        year = datetime.date.today().year
+        company = create_company()
+        with set_company(company):
+            line_type = setup_payroll(company)
+            data = create_payroll_data(company, line_type, year,
+                employees=1, rulesets=1, rules=2, shifts=4, interventions=0)
+            ruleset, = data['payroll.contract.ruleset']
+            rule1, rule2 = ruleset.rules
+            shifts = data['working_shift']
+            WorkingShift.done(shifts)
+            Payslip.generate_payslips(datetime.date(year, 1, 1),
+                datetime.date(year, 1, 31), line_type, Decimal(160))
+
+            def costs():
+                clear_transaction_cache()
+                return [
+                    (s.employee_contract_rule, s.cost_cache)
+                    for s in WorkingShift.browse([s.id for s in shifts])]
+
+            # The working shifts last 1, 2, 3 and 4 hours
+            self.assertEqual(costs(), [
+                    (rule1, Decimal('100.00')),
+                    (rule1, Decimal('100.00')),
+                    (rule2, Decimal('200.00')),
+                    (rule2, Decimal('200.00')),
+                    ])
+
+            # Only the working shifts of the rule are updated
+            Rule.write([rule1], {'cost_price': Decimal(150)})
+            self.assertEqual(costs(), [
+                    (rule1, Decimal('150.00')),
+                    (rule1, Decimal('150.00')),
+                    (rule2, Decimal('200.00')),
+                    (rule2, Decimal('200.00')),
+                    ])
+
+            # The working shifts of the ruleset are matched again
+            Rule.write([rule1], {'hours': Decimal(1)})
+            self.assertEqual(costs(), [
+                    (rule1, Decimal('150.00')),
+                    (rule2, Decimal('200.00')),
+                    (rule2, Decimal('200.00')),
+                    (rule2, Decimal('200.00')),
+                    ])
+            Rule.write([rule2], {'sequence': -1})
+            self.assertEqual(costs(), [(rule2, Decimal('200.00'))] * 4)
+
+    @with_transaction()
+    def test_contract_change_cost_cache(self):
+        "Test moving contract dates updates the cost cache"
+        pool = Pool()
+        Contract = pool.get('payroll.contract')
+        Payslip = pool.get('payroll.payslip')
+        Rule = pool.get('payroll.contract.rule')
+        WorkingShift = pool.get('working_shift')
+
+        year = datetime.date.today().year
+        company = create_company()
+        with set_company(company):
+            line_type = setup_payroll(company)
+            data = create_payroll_data(company, line_type, year,
+                employees=1, rulesets=2, rules=1, shifts=2, interventions=0)
+            contract, = data['payroll.contract']
+            _, ruleset = data['payroll.contract.ruleset']
+            Rule.write(list(ruleset.rules), {'cost_price': Decimal(500)})
+            shifts = data['working_shift']
+            WorkingShift.done(shifts)
+            Payslip.generate_payslips(datetime.date(year, 1, 1),
+                datetime.date(year, 1, 31), line_type, Decimal(160))
+
+            def costs():
+                clear_transaction_cache()
+                return [s.cost_cache
+                    for s in WorkingShift.browse([s.id for s in shifts])]
+
+            self.assertEqual(costs(), [Decimal('100.00')] * 2)
+
+            # The payslip is no more in the range of the contract
+            Contract.write([contract], {
+                    'start': datetime.date(year, 2, 1),
+                    })
+            self.assertEqual(costs(), [None] * 2)
+
+            # The payslip is in the range of the new contract
+            new_contract, = Contract.create([{
+                        'employee': contract.employee.id,
+                        'start': datetime.date(year, 1, 1),
+                        'end': datetime.date(year, 1, 31),
+                        'yearly_hours': Decimal(1840),
+                        'working_shift_hours': Decimal(8),
+                        'working_shift_price': Decimal(360),
+                        'ruleset': ruleset.id,
+                        }])
+            Contract.confirm([new_contract])
+            self.assertEqual(costs(), [Decimal('500.00')] * 2)
+
+    @with_transaction()
+    def test_invoiced_cost_cache(self):
+        "Test the cost cache of invoiced working shifts is not updated"
+        pool = Pool()
+        Payslip = pool.get('payroll.payslip')
+        Rule = pool.get('payroll.contract.rule')
+        WorkingShift = pool.get('working_shift')
+
+        year = datetime.date.today().year
+        company = create_company()
+        with set_company(company):
+            line_type = setup_payroll(company)
+            data = create_payroll_data(company, line_type, year,
+                employees=2, rulesets=1, rules=1, shifts=2, interventions=0)
+            ruleset, = data['payroll.contract.ruleset']
+            shifts = data['working_shift']
+            WorkingShift.done(shifts)
+            payslips = Payslip.generate_payslips(datetime.date(year, 1, 1),
+                datetime.date(year, 1, 31), line_type, Decimal(160))
+            invoiced, = [p for p in payslips
+                if p.employee == data['company.employee'][0]]
+            Payslip.create_supplier_invoices([invoiced])
+
+            Rule.write(list(ruleset.rules), {'cost_price': Decimal(150)})
+
+            clear_transaction_cache()
+            for shift in WorkingShift.browse([s.id for s in shifts]):
+                if shift.payslip == invoiced:
+                    self.assertEqual(shift.cost_cache, Decimal('100.00'))
+                else:
+                    self.assertEqual(shift.cost_cache, Decimal('150.00'))
+
 
 del ModuleTestCase
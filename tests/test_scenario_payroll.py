@@ -376,34 +376,26 @@ class Test(unittest.TestCase):
         self.assertEqual(line.remaining_hours, Decimal('160.00'))
         self.assertEqual(line.amount, Decimal('0'))
 
-        # Check employee contract hours summary
+        # Create leave period of the contract
+        leave_period3 = LeavePeriod(name=str(today.year))
+        leave_period3.start = datetime.date(today.year, 1, 1)
+        leave_period3.end = datetime.date(today.year, 12, 31)
+        leave_period3.save()
+
+        # Check employee contract hours summary only has the periods that
+        # overlap the contract
         contract.reload()
         summary_by_period = {
             s.leave_period.id: s
             for s in contract.hours_summary
         }
-        self.assertEqual(summary_by_period[leave_period.id].leave_hours,
-                         Decimal('40.00'))
-        self.assertEqual(summary_by_period[leave_period.id].hours_to_do,
-                         Decimal('0.00'))
-        self.assertEqual(summary_by_period[leave_period.id].worked_hours,
-                         Decimal('0.00'))
-        self.assertEqual(summary_by_period[leave_period.id].entitled_hours,
-                         Decimal('4.00'))
-        self.assertEqual(summary_by_period[leave_period.id].remaining_hours,
-                         Decimal('4.00'))
-        self.assertEqual(summary_by_period[leave_period.id].leave_payment_hours,
-                         Decimal('8.00'))
-        self.assertEqual(summary_by_period[leave_period2.id].leave_hours,
-                         Decimal('56.00'))
-        self.assertEqual(summary_by_period[leave_period2.id].hours_to_do,
-                         Decimal('0.00'))
-        self.assertEqual(summary_by_period[leave_period2.id].worked_hours,
-                         Decimal('0.00'))
-        self.assertEqual(summary_by_period[leave_period2.id].entitled_hours,
-                         Decimal('0.00'))
-        self.assertEqual(summary_by_period[leave_period2.id].remaining_hours,
-                         Decimal('0.00'))
-        self.assertEqual(
-            summary_by_period[leave_period2.id].leave_payment_hours,
-            Decimal('0.00'))
+        self.assertEqual(set(summary_by_period), {leave_period3.id})
+        summary = summary_by_period[leave_period3.id]
+        self.assertEqual(summary.working_hours, Decimal('320.00'))
+        self.assertEqual(summary.leave_hours, Decimal('8.00'))
+        self.assertEqual(summary.hours_to_do, Decimal('312.00'))
+        self.assertEqual(summary.worked_hours, Decimal('32.00'))
+        self.assertEqual(summary.entitled_hours, Decimal('0.00'))
+        self.assertEqual(summary.remaining_hours, Decimal('280.00'))
+        self.assertEqual(summary.extra_hours, Decimal('0.00'))
+        self.assertEqual(summary.leave_payment_hours, Decimal('0.00'))
@@ -0,0 +1,246 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+from decimal import Decimal
+
+from trytond.model import fields
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.company.tests import create_employee
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+def clear_transaction_cache():
+    "Empty the records cache of the current transaction"
+    transaction = Transaction()
+    transaction.counter += 1
+    for cache in transaction.cache.values():
+        cache.clear()
+
+
+def read_function_fields(Model, records):
+    "Read all the Function fields of the records"
+    names = [n for n, f in Model._fields.items()
+        if isinstance(f, fields.Function)]
+    return Model.read([r.id for r in records], names)
+
+
+def setup_payroll(company):
+    """
+    Create the accounting, the sequences and the payslip line type needed to
+    use payroll with the company.
+    Return the payslip line type.
+    """
+    pool = Pool()
+    FiscalYear = pool.get('account.fiscalyear')
+    ProductCategory = pool.get('product.category')
+    ProductTemplate = pool.get('product.template')
+    Uom = pool.get('product.uom')
+    Sequence = pool.get('ir.sequence')
+    WorkingShiftConfig = pool.get('working_shift.configuration')
+    PayslipLineType = pool.get('payroll.payslip.line.type')
+    Account = pool.get('account.account')
+
+    create_chart(company)
+    fiscalyear = set_invoice_sequences(get_fiscalyear(company))
+    fiscalyear.save()
+    FiscalYear.create_period([fiscalyear])
+
+    expense, = Account.search([
+            ('type.expense', '=', True),
+            ('closed', '=', False),
+            ('company', '=', company.id),
+            ], limit=1)
+    category, = ProductCategory.create([{
+                'name': "Payroll",
+                'accounting': True,
+                'account_expense': expense.id,
+                }])
+    hour, = Uom.search([('name', '=', 'Hour')])
+    template, = ProductTemplate.create([{
+                'name': "Professional Services",
+                'type': 'service',
+                'default_uom': hour.id,
+                'list_price': Decimal(0),
+                'account_category': category.id,
+                'products': [('create', [{}])],
+                }])
+    product, = template.products
+
+    config = WorkingShiftConfig(1)
+    config.working_shift_sequence, = Sequence.search([
+            ('sequence_type.name', '=', 'Working Shift'),
+            ])
+    config.intervention_sequence, = Sequence.search([
+            ('sequence_type.name', '=', 'Working Shift Intervention'),
+            ])
+    config.save()
+
+    line_type, = PayslipLineType.create([{
+                'name': "Normal",
+                'product': product.id,
+                }])
+    return line_type
+
+
+def create_payslip(contract, line_type, start, end, working_shifts=None):
+    """
+    Create the payslip of the contract between start and end with a line of
+    line_type with the working shifts
+    """
+    pool = Pool()
+    Payslip = pool.get('payroll.payslip')
+    WorkingShift = pool.get('working_shift')
+
+    payslip, = Payslip.create([{
+                'employee': contract.employee.id,
+                'contract': contract.id,
+                'start': start,
+                'end': end,
+                'lines': [('create', [{
+                                'type': line_type.id,
+                                'working_hours': Decimal(160),
+                                }])],
+                }])
+    line, = payslip.lines
+    if working_shifts:
+        WorkingShift.write(list(working_shifts), {'payslip_line': line.id})
+    return payslip
+
+
+def create_payroll_data(company, line_type, year, employees=10, contracts=1,
+        rulesets=2, rules=4, shifts=20, interventions=2, leaves=1,
+        entitlements=1, payments=1):
+    """
+    Create the synthetic payroll data of the year for the company.
+    Each employee gets contracts covering consecutive parts of the year and
+    in January the number of confirmed working shifts with their
+    interventions, done leaves, entitlements and leave payments.
+    The rules of odd rulesets alternate the working shift and intervention
+    compute methods.
+    Return a dictionary with the created records by model name.
+    """
+    pool = Pool()
+    RuleSet = pool.get('payroll.contract.ruleset')
+    Contract = pool.get('payroll.contract')
+    LeavePeriod = pool.get('employee.leave.period')
+    LeaveType = pool.get('employee.leave.type')
+    Leave = pool.get('employee.leave')
+    Entitlement = pool.get('employee.leave.entitlement')
+    LeavePayment = pool.get('employee.leave.payment')
+    WorkingShift = pool.get('working_shift')
+    Intervention = pool.get('working_shift.intervention')
+
+    contracts = max(1, min(contracts, 12))
+    january = datetime.date(year, 1, 1)
+
+    rulesets = RuleSet.create([{
+                'name': "Ruleset %s" % r,
+                'rules': [('create', [{
+                                'sequence': j,
+                                'compute_method': (
+                                    'intervention' if r % 2 and j % 2
+                                    else 'working_shift'),
+                                'hours': Decimal(2 * (j + 1)),
+                                'hour_type': line_type.id,
+                                'cost_price': Decimal(100 * (j + 1)),
+                                } for j in range(rules)])],
+                } for r in range(rulesets)])
+
+    period, = LeavePeriod.create([{
+                'name': str(year),
+                'start': january,
+                'end': datetime.date(year, 12, 31),
+                }])
+    leave_type, = LeaveType.create([{'name': "Holidays"}])
+
+    employee_records = []
+    contract_values = []
+    for i in range(employees):
+        employee = create_employee(company, name="Employee %s" % i)
+        employee_records.append(employee)
+        for c in range(contracts):
+            start = datetime.date(year, 1 + 12 * c // contracts, 1)
+            if c + 1 < contracts:
+                end = (datetime.date(year, 1 + 12 * (c + 1) // contracts, 1)
+                    - datetime.timedelta(days=1))
+            else:
+                end = datetime.date(year, 12, 31)
+            contract_values.append({
+                    'employee': employee.id,
+                    'start': start,
+                    'end': end,
+                    'yearly_hours': Decimal(1840),
+                    'working_shift_hours': Decimal(8),
+                    'working_shift_price': Decimal(360),
+                    'ruleset': rulesets[i % len(rulesets)].id,
+                    })
+    contract_records = Contract.create(contract_values)
+    Contract.confirm(contract_records)
+
+    shift_values = []
+    for employee in employee_records:
+        for s in range(shifts):
+            start = datetime.datetime.combine(
+                january + datetime.timedelta(days=s % 28),
+                datetime.time(8)) + datetime.timedelta(minutes=s // 28)
+            shift_values.append({
+                    'employee': employee.id,
+                    'start': start,
+                    'end': start + datetime.timedelta(hours=1 + s % 8),
+                    })
+    shift_records = WorkingShift.create(shift_values)
+    WorkingShift.confirm(shift_records)
+
+    intervention_records = Intervention.create([{
+                'shift': shift.id,
+                'start': shift.start + datetime.timedelta(minutes=10 * n),
+                'end': shift.start + datetime.timedelta(minutes=10 * n + 5),
+                }
+            for shift in shift_records for n in range(interventions)])
+
+    leave_values, entitlement_values, payment_values = [], [], []
+    for employee in employee_records:
+        for n in range(leaves):
+            day = january + datetime.timedelta(days=n % 28)
+            leave_values.append({
+                    'employee': employee.id,
+                    'period': period.id,
+                    'type': leave_type.id,
+                    'request_date': january,
+                    'hours': Decimal(8),
+                    'start': day,
+                    'end': day,
+                    })
+        for n in range(entitlements):
+            entitlement_values.append({
+                    'employee': employee.id,
+                    'period': period.id,
+                    'type': leave_type.id,
+                    'date': january + datetime.timedelta(days=n % 28),
+                    'hours': Decimal(4),
+                    })
+        for n in range(payments):
+            payment_values.append({
+                    'employee': employee.id,
+                    'period': period.id,
+                    'type': leave_type.id,
+                    'date': january + datetime.timedelta(days=n % 28),
+                    'hours': Decimal(8),
+                    })
+    leave_records = Leave.create(leave_values)
+    Leave.approve(leave_records)
+    Leave.done(leave_records)
+
+    return {
+        'company.employee': employee_records,
+        'payroll.contract.ruleset': rulesets,
+        'payroll.contract': contract_records,
+        'employee.leave.period': [period],
+        'working_shift': shift_records,
+        'working_shift.intervention': intervention_records,
+        'employee.leave': leave_records,
+        'employee.leave.entitlement': Entitlement.create(entitlement_values),
+        'employee.leave.payment': LeavePayment.create(payment_values),
+        }